@@ -38,6 +38,8 @@ def read_file(filename, progress_handler=None):
     extension = filename.split(".")[-1]
     if extension == "vtp":
         reader = vtk.vtkXMLPolyDataReader()
+    elif extension == "pvtp":
+        reader = vtk.vtkXMLPPolyDataReader()
     elif extension == "vtu":
         reader = vtk.vtkXMLUnstructuredGridReader()
     elif extension == "mhd":
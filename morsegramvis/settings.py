@@ -17,8 +17,11 @@ class Config:
 
     APP_DATA_DIR = ".morsegram"
     FILE_EXT = ".vtp"
+    # polydata file extensions, the partitioned .pvtp index is preferred
+    FILE_EXTS = (".pvtp", ".vtp")
     BASE_DIR = ""
     PERS_CURVE_FILE = None
+    PERS_DIAGM_FILE = None
 
     BG_COLOR = (0, 0, 0)
     AMBIENT = 0.5
@@ -35,6 +38,17 @@ class Config:
     def isinit():
         return Config.BASE_DIR != ""
 
+    @staticmethod
+    def polydata_file(name):
+        '''
+        Path of the polydata file name in the base folder, the .pvtp index
+        when the pipeline wrote it in pieces
+        '''
+        for ext in Config.FILE_EXTS:
+            if os.path.exists(Config.BASE_DIR + "/" + name + ext):
+                return Config.BASE_DIR + "/" + name + ext
+        return Config.BASE_DIR + "/" + name + Config.FILE_EXT
+
     @staticmethod
     def set_base_folder(data):
         data = data['settings']
@@ -83,21 +97,28 @@ class Config:
         Config.BASE_DIR = data['base_folder']
 
         # iterate over all files in the folder
-        for filename in os.listdir(Config.BASE_DIR):
-            if filename.endswith("segmentation" + Config.FILE_EXT):
-                Config.SEGMENTATION_FILE   = Config.BASE_DIR + "/" + filename
-            elif filename.endswith("contact_regions" + Config.FILE_EXT):
-                Config.CONTACT_REGION_FILE = Config.BASE_DIR + "/" + filename
-            elif filename.endswith("contacts" + Config.FILE_EXT):
-                Config.CONTACT_NET_FILE    = Config.BASE_DIR + "/" + filename
-            elif filename.endswith("grain_centres" + Config.FILE_EXT):
-                Config.MAXIMAS_FILE        = Config.BASE_DIR + "/" + filename
-            elif filename.endswith("contacts_all" + Config.FILE_EXT):
-                Config.ALL_CONTACTS_FILE = Config.BASE_DIR + "/" + filename
+        # .pvtp files come first, so a .vtp never replaces the .pvtp of an output
+        polydata = {"segmentation": "SEGMENTATION_FILE",
+                    "contact_regions": "CONTACT_REGION_FILE",
+                    "contacts": "CONTACT_NET_FILE",
+                    "grain_centres": "MAXIMAS_FILE",
+                    "contacts_all": "ALL_CONTACTS_FILE"}
+        found = set()
+        filenames = sorted(os.listdir(Config.BASE_DIR),
+                           key=lambda f: not f.endswith(Config.FILE_EXTS[0]))
+        for filename in filenames:
+            stem, ext = os.path.splitext(filename)
+            if ext in Config.FILE_EXTS:
+                for name, attr in polydata.items():
+                    if stem.endswith(name) and attr not in found:
+                        setattr(Config, attr, Config.BASE_DIR + "/" + filename)
+                        found.add(attr)
             elif filename.endswith("_initial.txt"):
                 Config.PERS_VAL_FILE = Config.BASE_DIR + "/" + filename
             elif filename.endswith(".svg"):
                 Config.PERS_CURVE_FILE = Config.BASE_DIR + "/" + filename
+            elif filename.endswith("_initial_pers.npz"):
+                Config.PERS_DIAGM_FILE = Config.BASE_DIR + "/" + filename
 
         Config.PARTICLES_MESH_DIR = Config.BASE_DIR + "/ensemble/"
         Config.DEM_DIR = Config.BASE_DIR + "/dem/"
@@ -126,8 +147,8 @@ class Config:
         Config.PARTICLE_STATS_FILE = Config.DATA_DIR + "all_particle_stats.csv"
         Config.ENSEMBLE_FILE = Config.BASE_DIR + "/ensemble.vtu"
         Config.ENSEMBLE_CLEAN_FILE = Config.BASE_DIR + "/ensemble_clean.vtu"
-        Config.CP3_FILE = Config.BASE_DIR + "/cps_3.vtp"
-        Config.CP2_FILE = Config.BASE_DIR + "/cps_2.vtp"
+        Config.CP3_FILE = Config.polydata_file("cps_3")
+        Config.CP2_FILE = Config.polydata_file("cps_2")
         Config.CP_PAIR_FILE = Config.BASE_DIR + "/cp_pairs.csv"
         Config.SIMPLIFIED_DIR = Config.BASE_DIR + "/simplified/"
 
@@ -382,6 +382,24 @@ def display_image(filename):
     dialog.exec_()
 
 
+def get_pers_curve_chart(filename, max_points=1000):
+    '''
+    Persistence curve from the persistence pairs cached by the pipeline
+
+    @param filename: The .npz file with birth and death arrays
+    @param max_points: Number of points plotted at most
+    @return: The widget chart
+    '''
+    with np.load(filename) as f:
+        pers = np.sort(f["death"] - f["birth"])
+    survived = np.arange(len(pers))[::-1]
+
+    # subsample long curves
+    ind = np.unique(np.linspace(0, len(pers) - 1, max_points).astype(int))
+    return get_linechart(pers[ind], survived[ind], "Persistence Curve",
+                         "Persistence", "Survived Critical Points")
+
+
 def get_overview_widget():
     '''
     Overview widget
@@ -428,6 +446,8 @@ def get_overview_widget():
                 label.setPixmap(QtGui.QPixmap(Config.PERS_CURVE_FILE))
                 label.setScaledContents(True)
                 label.mousePressEvent = lambda event: display_image(Config.PERS_CURVE_FILE)
+            elif Config.PERS_DIAGM_FILE is not None:
+                label = get_pers_curve_chart(Config.PERS_DIAGM_FILE)
             else:
                 label.setText("Persistence curve file not found")
 
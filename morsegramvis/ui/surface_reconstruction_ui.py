@@ -517,9 +517,10 @@ class SurfaceReconstructionForm(form_nav.Form_Nav):
         # remove chamf_distance_
         if seg_file.find("chamf_distance_") != -1:
             seg_file = seg_file.replace("chamf_distance_", "")
-        # remove _segmentation.vtp
-        if seg_file.find("_segmentation.vtp") != -1:
-            seg_file = seg_file.replace("_segmentation.vtp", "")
+        # remove _segmentation.vtp / _segmentation.pvtp
+        for ext in Config.FILE_EXTS:
+            if seg_file.find("_segmentation" + ext) != -1:
+                seg_file = seg_file.replace("_segmentation" + ext, "")
         ens_info.dataset_name = seg_file
         # read txt file
         pers_val = 0
@@ -3,8 +3,12 @@ import h5py
 import os
 import numpy as np
 import SimpleITK as sitk
+import sys
 from scipy import io
-from skimage.measure import block_reduce
+
+# shared downsampling kernel of the pipeline
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from downsample import downsample
 
 parser = argparse.ArgumentParser(description='Convert .mat into .raw')
 parser.add_argument('filename', type=str,
@@ -35,8 +39,7 @@ if sci:
 print(f'Original: {arr.shape}')
 
 if (factor > 1):
-    arr = block_reduce(arr, (factor, factor, factor),
-                       func=np.mean).astype(np.uint16)
+    arr = downsample(arr, factor)
     print(f'Downsampled: {arr.shape}')
     filename += f'_downsampled_{factor}'
 
@@ -1,8 +1,12 @@
-from skimage.measure import block_reduce
 import SimpleITK as sitk
 import numpy as np
 import argparse
 import os
+import sys
+
+# shared downsampling kernel of the pipeline
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from downsample import downsample
 
 parser = argparse.ArgumentParser()
 parser.add_argument('data_file', type=str, help='data file name')
@@ -20,7 +24,7 @@ img_arr = reader.Execute()
 
 img_arr = sitk.GetArrayFromImage(img_arr)
 print(np.shape(img_arr))
-downsampled_img = block_reduce(img_arr, fac, func=np.mean).astype(np.uint16)
+downsampled_img = downsample(img_arr, fac)
 print(np.shape(downsampled_img))
 
 downsampled_img = sitk.GetImageFromArray(downsampled_img)
@@ -1,6 +1,15 @@
 # import modules
+from concurrent.futures import ThreadPoolExecutor
+import h5py
+import logging
+import numpy as np
+import os
 import SimpleITK as sitk
+import threading
+import time
 import vtk
+import vtk.util.numpy_support as nps
+from polydata_utils import cell_pieces, extract_piece
 
 # Here we can also add functions to write polydata from numpy array instead of writing it in main.py
 
@@ -19,6 +28,106 @@ def write_img_from_arr(arr, file_name):
     writer.Execute(img)
 
 
+def label_dtype(max_label):
+    """Narrowest unsigned integer type holding the labels.
+
+    Args:
+        max_label (int): largest label
+
+    Returns:
+        numpy dtype: uint8, uint16, uint32 or uint64
+    """
+    for dtype in (np.uint8, np.uint16, np.uint32, np.uint64):
+        if max_label <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    raise ValueError(f"Label {max_label} does not fit in 64 bits")
+
+
+def write_labels_h5(arr, file_name, chunk_size=64, compression_level=4,
+                    stats=None):
+    """Write a label volume as a chunked, compressed HDF5 dataset.
+
+    Args:
+        arr (numpy array): label volume, in x, y, z order
+        file_name (str): file name to be written, without extension
+        chunk_size (int, optional): edge of the cubic chunks. Defaults to 64.
+        compression_level (int, optional): gzip level. Defaults to 4.
+        stats (dict, optional): output of label_stats.compute_label_stats, the
+            bounding boxes are stored for read_grain. Defaults to None.
+
+    Description:
+        The 'labels' dataset keeps the x, y, z order of the array, so no transposed
+        copy is made, and uses the narrowest dtype for the largest label. It is
+        written a slab of chunks at a time; background chunks compress to almost
+        nothing and HDF5 keeps an index of the chunks for partial reads.
+    """
+    dtype = label_dtype(int(arr.max(initial=0)))
+    chunks = tuple(min(chunk_size, n) for n in arr.shape)
+    with h5py.File(file_name + '.h5', 'w') as f:
+        ds = f.create_dataset('labels', shape=arr.shape, dtype=dtype,
+                              chunks=chunks, compression='gzip',
+                              compression_opts=compression_level, shuffle=True)
+        ds.attrs['axes'] = 'xyz'
+        for x0 in range(0, arr.shape[0], chunks[0]):
+            ds[x0:x0 + chunks[0]] = arr[x0:x0 + chunks[0]].astype(dtype, copy=False)
+        if stats is not None:
+            f.create_dataset('bbox_label', data=stats['label'])
+            f.create_dataset('bbox_min', data=stats['bbox_min'])
+            f.create_dataset('bbox_max', data=stats['bbox_max'])
+
+
+def read_label_chunk(file_name, index):
+    """Read one chunk of a label volume written by write_labels_h5.
+
+    Args:
+        file_name (str): .h5 file name
+        index (tuple): position of the chunk in the chunk grid
+
+    Returns:
+        numpy array: labels of the chunk
+        tuple: x, y, z of the first voxel of the chunk
+    """
+    with h5py.File(file_name, 'r') as f:
+        ds = f['labels']
+        lo = tuple(i * c for i, c in zip(index, ds.chunks))
+        return ds[tuple(slice(l, l + c) for l, c in zip(lo, ds.chunks))], lo
+
+
+def read_label_region(file_name, lo, hi):
+    """Read a box of a label volume written by write_labels_h5.
+
+    Args:
+        file_name (str): .h5 file name
+        lo (tuple): first voxel of the box
+        hi (tuple): last voxel of the box (inclusive)
+
+    Returns:
+        numpy array: labels of the box, only the chunks it touches are decompressed
+    """
+    with h5py.File(file_name, 'r') as f:
+        return f['labels'][tuple(slice(l, h + 1) for l, h in zip(lo, hi))]
+
+
+def read_grain(file_name, label):
+    """Read the voxels of one grain of a label volume written by write_labels_h5.
+
+    Args:
+        file_name (str): .h5 file name, written with stats
+        label (int): label of the grain
+
+    Returns:
+        numpy array: mask of the grain in its bounding box
+        numpy array: x, y, z of the first voxel of the bounding box
+    """
+    with h5py.File(file_name, 'r') as f:
+        labels = f['bbox_label'][:]
+        row = np.searchsorted(labels, label)
+        if row == len(labels) or labels[row] != label:
+            raise KeyError(f"Label {label} is not in {file_name}")
+        lo, hi = f['bbox_min'][row], f['bbox_max'][row]
+    return read_label_region(file_name, lo, hi) == label, lo
+
+
 def write_polydata(pd, file_name):
     """Write vtk polydata to file.
 
@@ -31,3 +140,164 @@ def write_polydata(pd, file_name):
     writer.SetInputData(pd)
     writer.Write()
     return
+
+
+# XML type names of the numpy types
+XML_TYPES = {np.dtype(t): n for t, n in (
+    (np.int8, 'Int8'), (np.uint8, 'UInt8'), (np.int16, 'Int16'), (np.uint16, 'UInt16'),
+    (np.int32, 'Int32'), (np.uint32, 'UInt32'), (np.int64, 'Int64'), (np.uint64, 'UInt64'),
+    (np.float32, 'Float32'), (np.float64, 'Float64'))}
+
+
+def _pdata_arrays(data):
+    """PDataArray elements describing the arrays of point or cell data."""
+    lines = []
+    for i in range(data.GetNumberOfArrays()):
+        arr = data.GetArray(i)
+        if arr is None:
+            continue
+        lines.append('      <PDataArray type="%s" Name="%s" NumberOfComponents="%d"/>'
+                     % (XML_TYPES[nps.vtk_to_numpy(arr).dtype], arr.GetName(),
+                        arr.GetNumberOfComponents()))
+    return lines
+
+
+def write_pvtp(pd, file_name, num_pieces, split='id', num_threads=None):
+    """Write vtk polydata as pieces with a .pvtp index.
+
+    Args:
+        pd (vtk polydata): polydata to be written
+        file_name (str): .pvtp file name to be written
+        num_pieces (int): number of pieces
+        split (str, optional): 'id' -- ranges of cell ids, 'spatial' -- slabs along the
+            longest side of the bounding box. Defaults to 'id'.
+        num_threads (int, optional): number of pieces written at a time. Defaults to
+            num_pieces.
+
+    Description:
+        The pieces are written as [name]/[name]_[i].vtp next to the index, which lists
+        them in the PPolyData format read by ParaView and vtkXMLPPolyDataReader, so a
+        reader can load some of the pieces or all of them in parallel.
+    """
+    stem = os.path.splitext(os.path.basename(file_name))[0]
+    piece_dir = os.path.join(os.path.dirname(file_name), stem)
+    os.makedirs(piece_dir, exist_ok=True)
+
+    pieces = cell_pieces(pd, num_pieces, split)
+    sources = [stem + '/' + stem + '_%d.vtp' % i for i in range(num_pieces)]
+
+    def write_piece(i):
+        write_polydata(extract_piece(pd, pieces == i),
+                       os.path.join(os.path.dirname(file_name), sources[i]))
+
+    with ThreadPoolExecutor(num_threads or num_pieces) as pool:
+        list(pool.map(write_piece, range(num_pieces)))
+
+    pts_type = XML_TYPES[nps.vtk_to_numpy(pd.GetPoints().GetData()).dtype]
+    lines = ['<?xml version="1.0"?>',
+             '<VTKFile type="PPolyData" version="1.0" byte_order="%s" header_type="UInt64">'
+             % ('LittleEndian' if np.little_endian else 'BigEndian'),
+             '  <PPolyData GhostLevel="0">',
+             '    <PPointData>'] + _pdata_arrays(pd.GetPointData()) + [
+             '    </PPointData>',
+             '    <PCellData>'] + _pdata_arrays(pd.GetCellData()) + [
+             '    </PCellData>',
+             '    <PPoints>',
+             '      <PDataArray type="%s" NumberOfComponents="3"/>' % pts_type,
+             '    </PPoints>'] + [
+             '    <Piece Source="%s"/>' % src for src in sources] + [
+             '  </PPolyData>',
+             '</VTKFile>']
+    with open(file_name, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+class BackgroundWriter:
+    """Write pipeline outputs on background threads.
+
+    Args:
+        num_threads (int, optional): number of writer threads. Defaults to 2.
+        max_pending (int, optional): submitting blocks while this many writes are
+            queued or running, which bounds the memory held by finished outputs.
+            Defaults to 4.
+        num_pieces (int, optional): polydata with at least min_piece_points points is
+            written as this many pieces with a .pvtp index. Defaults to 1.
+        split (str, optional): 'id' or 'spatial' pieces, see write_pvtp. Defaults to 'id'.
+        min_piece_points (int, optional): smaller polydata is written as one file.
+            Defaults to 1000000.
+
+    Description:
+        Finished outputs are handed to the writer and the computation continues;
+        flush is the barrier at the end of a stage. Every write is timed in the log.
+        The outputs must not be modified after they are submitted.
+    """
+
+    def __init__(self, num_threads=2, max_pending=4, num_pieces=1, split='id',
+                 min_piece_points=1000000):
+        self.pool = ThreadPoolExecutor(num_threads, thread_name_prefix='writer')
+        self.num_pieces, self.split = num_pieces, split
+        self.min_piece_points = min_piece_points
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.pending = []
+        self.log = logging.getLogger(__name__)
+
+    def submit(self, func, file_name, *args):
+        """Queue func(*args, file_name).
+
+        Args:
+            func (function): writer function, taking the file name last
+            file_name (str): file to be written
+            *args: outputs passed to func before the file name
+        """
+        self.slots.acquire()
+        try:
+            self.pending.append(self.pool.submit(self._write, func, file_name, args))
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def _write(self, func, file_name, args):
+        try:
+            start = time.perf_counter()
+            func(*args, file_name)
+            self.log.info('wrote %s in %.2f s', file_name, time.perf_counter() - start)
+        finally:
+            self.slots.release()
+
+    def write_polydata(self, pd, file_name):
+        """Queue write_polydata(pd, file_name), or write_pvtp for large polydata."""
+        if self.num_pieces > 1 and pd.GetNumberOfPoints() >= self.min_piece_points:
+            self.submit(lambda pd, f: write_pvtp(pd, f, self.num_pieces, self.split),
+                        os.path.splitext(file_name)[0] + '.pvtp', pd)
+        else:
+            self.submit(write_polydata, file_name, pd)
+
+    def write_img_from_arr(self, arr, file_name):
+        """Queue write_img_from_arr(arr, file_name)."""
+        self.submit(write_img_from_arr, file_name, arr)
+
+    def flush(self, stage=None):
+        """Wait for all the queued writes.
+
+        Args:
+            stage (str, optional): name of the stage, for the log. Defaults to None.
+
+        Raises:
+            Exception: the first error of a queued write
+        """
+        start = time.perf_counter()
+        pending, self.pending = self.pending, []
+        errors = [f.exception() for f in pending]
+        if stage is not None:
+            self.log.info('%s: waited %.2f s for %d writes', stage,
+                          time.perf_counter() - start, len(pending))
+        for e in errors:
+            if e is not None:
+                raise e
+
+    def close(self):
+        """Flush and stop the writer threads."""
+        try:
+            self.flush()
+        finally:
+            self.pool.shutdown()
@@ -2,6 +2,7 @@ import argparse
 import numpy as np
 import os
 import SimpleITK as sitk
+from histogram import contrast_stretch
 from utilities import read_input_file
 from utilities import bd_extraction
 from utilities import dist_field_comp
@@ -52,17 +53,16 @@ if __name__ == "__main__":
     # read the mat file and get the data -- optionally downsample
     arr = read_input_file(input_file_name, factor)
 
-    # adjust data range (contrast adjustment - imadjust)
-    low, upp, typ = np.quantile(arr, 0.01), np.quantile(arr, 0.99), arr.dtype
-    arr = (2**16 - 1) * (arr - low) / (upp - low)
-    arr = (np.clip(arr, 0, 2**16-1)).astype(typ)
+    # adjust data range (contrast adjustment - imadjust) in place
+    # hist is the histogram of the adjusted data, None unless uint8 / uint16
+    hist = contrast_stretch(arr, 0.01, 0.99)
 
 
     # write the downsampled file for visualization
     sitk.WriteImage(sitk.GetImageFromArray(arr), dirpath + '/' + base_name + '_ds_'+ str(factor) + '.mhd')
 
     # get the binary volume
-    ls = bd_extraction(arr, slicewise=slicewise, filterName=filtername)
+    ls = bd_extraction(arr, slicewise=slicewise, filterName=filtername, hist=hist)
     # get the distance field
     dist_field = dist_field_comp(ls)
 
@@ -0,0 +1,124 @@
+# import modules
+import numba
+from numba import jit
+import numpy as np
+
+# Block downsampling of volumes in one parallel pass, a box filter that
+# accumulates in integers (floats for other than uint8 / uint16 volumes) and
+# writes uint16 directly.
+
+MODES = ('mean', 'max', 'median')
+
+
+@jit(nopython=True, parallel=True)
+def _block_sum_max(arr, fx, fy, fz, acc_row, use_max, out):
+    """Block sums (or maxima) of arr, divided by the valid voxel counts for the mean.
+
+    Args:
+        arr (numpy array): volume
+        fx, fy, fz (int): block size along every axis
+        acc_row (numpy array): initial accumulator (ny_out, nz), zero or the lowest
+            value for the maxima
+        use_max (bool): block maxima instead of means
+        out (numpy array): downsampled volume (nx_out, ny_out, nz_out)
+    """
+    nx, ny, nz = arr.shape
+    nxo, nyo, nzo = out.shape
+    for ox in numba.prange(nxo):
+        # reduce the rows of the block slices first, the last axis is contiguous
+        acc = acc_row.copy()
+        x1 = min(ox * fx + fx, nx)
+        for x in range(ox * fx, x1):
+            for y in range(ny):
+                oy = y // fy
+                for z in range(nz):
+                    if use_max:
+                        acc[oy, z] = max(acc[oy, z], arr[x, y, z])
+                    else:
+                        acc[oy, z] += arr[x, y, z]
+
+        # then the blocks along the last axis
+        bx = x1 - ox * fx
+        for oy in range(nyo):
+            by = min(oy * fy + fy, ny) - oy * fy
+            for oz in range(nzo):
+                z1 = min(oz * fz + fz, nz)
+                val = acc[oy, oz * fz]
+                for z in range(oz * fz + 1, z1):
+                    if use_max:
+                        val = max(val, acc[oy, z])
+                    else:
+                        val += acc[oy, z]
+                if use_max:
+                    out[ox, oy, oz] = val
+                else:
+                    out[ox, oy, oz] = val // (bx * by * (z1 - oz * fz))
+
+
+@jit(nopython=True, parallel=True)
+def _block_median(arr, fx, fy, fz, out):
+    """Block medians of arr, see _block_sum_max."""
+    nx, ny, nz = arr.shape
+    nxo, nyo, nzo = out.shape
+    for ox in numba.prange(nxo):
+        buf = np.empty(fx * fy * fz, dtype=arr.dtype)
+        for oy in range(nyo):
+            for oz in range(nzo):
+                n = 0
+                for x in range(ox * fx, min(ox * fx + fx, nx)):
+                    for y in range(oy * fy, min(oy * fy + fy, ny)):
+                        for z in range(oz * fz, min(oz * fz + fz, nz)):
+                            buf[n] = arr[x, y, z]
+                            n += 1
+                out[ox, oy, oz] = np.median(buf[:n])
+
+
+def downsample(arr, factor, mode='mean', out=None):
+    """Downsample a volume by blocks.
+
+    Args:
+        arr (numpy array): three dimensional integer or float volume
+        factor (int or tuple): block size, for every axis or per axis
+        mode (str, optional): 'mean', 'max' or 'median' of every block. Defaults to 'mean'.
+        out (numpy array, optional): uint16 output of shape ceil(arr.shape / factor),
+            e.g. a part of a larger preallocated volume. Defaults to None.
+
+    Description:
+        Replaces block_reduce(arr, factor, func=np.mean).astype(np.uint16) without the
+        float64 copy. The sums of uint8 / uint16 volumes are accumulated in uint32
+        (uint64 for blocks of more than 65537 voxels), those of other volumes in
+        float64, and the mean is rounded down. Blocks at the end of an axis
+        that is not a multiple of the factor take the mean over their valid voxels,
+        where block_reduce pads them with zeros.
+
+    Raises:
+        ValueError: unknown mode, or arr is not an integer or float volume
+
+    Returns:
+        numpy array: downsampled volume (uint16)
+    """
+    if mode not in MODES:
+        raise ValueError('unknown downsampling mode ' + mode)
+    if arr.dtype.kind not in 'uif':
+        raise ValueError('downsampling a %s volume' % arr.dtype)
+    if not arr.dtype.isnative:
+        arr = arr.astype(arr.dtype.newbyteorder('='))
+    fx, fy, fz = (int(f) for f in np.broadcast_to(factor, 3))
+    shape = tuple(-(-n // f) for n, f in zip(arr.shape, (fx, fy, fz)))
+    if out is None:
+        out = np.empty(shape, dtype=np.uint16)
+    elif out.shape != shape:
+        raise ValueError('output of shape %s instead of %s' % (out.shape, shape))
+
+    if mode == 'median':
+        _block_median(arr, fx, fy, fz, out)
+    else:
+        if arr.dtype not in (np.uint8, np.uint16):
+            acc_type = np.float64
+        else:
+            acc_type = np.uint32 if fx * fy * fz <= 65537 else np.uint64
+        acc_row = np.zeros((shape[1], arr.shape[2]), dtype=acc_type)
+        if mode == 'max' and acc_type == np.float64:
+            acc_row[...] = -np.inf
+        _block_sum_max(arr, fx, fy, fz, acc_row, mode == 'max', out)
+    return out
@@ -0,0 +1,285 @@
+# import modules
+import hashlib
+import logging
+import numpy as np
+import os
+
+# Descending / ascending manifolds of all the critical points of one type,
+# collected once from the Morse complex and flattened into CSR arrays:
+#   cp_ids  -- critical points, in the order of msc.cps(dim)
+#   offsets -- geometry of cp_ids[i] is cells[offsets[i]:offsets[i + 1]]
+#   cells   -- concatenated des_geom / asc_geom of all the critical points
+#   points  -- primal or dual points the cells index into
+# Next to a saved msc the arrays are stored as .npy files that later stages
+# and reruns memory-map instead of calling into pyms3d per critical point.
+# The points only depend on the msc file, they are saved once per msc file and
+# shared by the stores of all the critical point types and thresholds. A store
+# is keyed by the msc file and the critical points that survive in the msc it
+# was built from, the threshold in its name is only the one asked for.
+
+STORE_ARRAYS = ('cp_ids', 'offsets', 'cells')
+
+
+def store_prefix(msc_file, dim, dir, pers_thresh=None):
+    """File prefix of the geometry store of a saved msc.
+
+    Args:
+        msc_file (str): file the msc is saved in
+        dim (int): critical point type
+        dir (int): 0 -- descending, 1 -- ascending
+        pers_thresh (float, optional): threshold the msc is simplified with. Defaults to None.
+
+    Returns:
+        str: prefix of the .npy files
+    """
+    # repr keeps every digit, close thresholds never share a store
+    thresh = 'initial' if pers_thresh is None else repr(float(pers_thresh))
+    return '%s_geom_%d_%s_%s' % (msc_file, dim, ('des', 'asc')[dir], thresh)
+
+
+def points_file(msc_file, points):
+    """File of the primal or dual points of a saved msc.
+
+    Args:
+        msc_file (str): file the msc is saved in
+        points (str): "primal" or "dual"
+
+    Returns:
+        str: .npy file name
+    """
+    return '%s_%s_points.npy' % (msc_file, points)
+
+
+def msc_file_key(msc_file):
+    """Key identifying the saved msc a store was built from.
+
+    Args:
+        msc_file (str): file the msc is saved in
+
+    Returns:
+        str: size and modification time of the file
+    """
+    st = os.stat(msc_file)
+    return '%d-%d' % (st.st_size, st.st_mtime_ns)
+
+
+def cps_key(msc, dim):
+    """Key of the critical points of one type that survive in the msc.
+
+    Args:
+        msc (msc object): Morse complex object
+        dim (int): critical point type
+
+    Returns:
+        str: hash of msc.cps(dim)
+    """
+    cps = np.ascontiguousarray(msc.cps(dim), dtype=np.int64)
+    return hashlib.sha1(cps.tobytes()).hexdigest()
+
+
+def build_geom_store(msc, dim, dir, points=None):
+    """Collect the geometry of all the critical points of one type.
+
+    Args:
+        msc (msc object): Morse complex object
+        dim (int): critical point type
+        dir (int): 0 -- descending, 1 -- ascending
+        points (str, optional): "primal" or "dual", the points the cells index into,
+            None to leave them out. Defaults to None.
+
+    Returns:
+        dict: cp_ids, offsets, cells and points arrays
+    """
+    msc.collect_geom(dim=dim, dir=dir)
+    cp_ids = np.asarray(msc.cps(dim), dtype=np.int64)
+    get_geom = msc.des_geom if dir == 0 else msc.asc_geom
+    geoms = [np.asarray(get_geom(c), dtype=np.int64).ravel() for c in cp_ids]
+
+    offsets = np.zeros(len(cp_ids) + 1, dtype=np.int64)
+    np.cumsum([len(g) for g in geoms], out=offsets[1:])
+    cells = np.concatenate([np.empty(0, dtype=np.int64)] + geoms)
+    if cells.max(initial=0) < np.iinfo(np.int32).max:
+        cells = cells.astype(np.int32)
+    store = dict(cp_ids=cp_ids, offsets=offsets, cells=cells)
+    if points is not None:
+        store['points'] = get_points(msc, points)
+    return store
+
+
+def get_points(msc, points):
+    """Primal or dual points of the msc.
+
+    Args:
+        msc (msc object): Morse complex object
+        points (str): "primal" or "dual"
+
+    Returns:
+        np array: point coordinates
+    """
+    return np.asarray(msc.primal_points() if points == "primal" else msc.dual_points())
+
+
+def save_points(msc, points, msc_file, key):
+    """Write the points of a saved msc once, for all of its geometry stores.
+
+    Args:
+        msc (msc object): Morse complex object
+        points (str): "primal" or "dual"
+        msc_file (str): file the msc is saved in
+        key (str): key of the msc file
+
+    Returns:
+        str: file of the points
+    """
+    file_name = points_file(msc_file, points)
+    key_file = file_name[:-len('.npy')] + '_key.npy'
+    if not os.path.exists(key_file) or str(np.load(key_file)) != key:
+        np.save(file_name, get_points(msc, points))
+        # the key is written last, partial points are never picked up
+        np.save(key_file, np.array(key))
+    return file_name
+
+
+def save_geom_store(prefix, key, store, pts_file):
+    """Write a geometry store as .npy files.
+
+    Args:
+        prefix (str): prefix of the files
+        key (str): key of the msc file the store was built from
+        store (dict): cp_ids, offsets and cells arrays
+        pts_file (str): file of the points the cells index into, see save_points
+    """
+    for name in STORE_ARRAYS:
+        np.save(prefix + '_' + name + '.npy', store[name])
+    np.save(prefix + '_points_file.npy', np.array(pts_file))
+    logging.getLogger(__name__).info(
+        'geometry store %s: %.1f MB', prefix,
+        sum(store[name].nbytes for name in STORE_ARRAYS) / 2**20)
+    # the key is written last, a partial store is never picked up
+    np.save(prefix + '_key.npy', np.array(key))
+
+
+def load_geom_store(prefix, key=None, mmap_mode='r'):
+    """Open a geometry store written by save_geom_store.
+
+    Args:
+        prefix (str): prefix of the files
+        key (str, optional): the store has to belong to this key. Defaults to None.
+        mmap_mode (str, optional): memory-map the arrays. Defaults to 'r'.
+
+    Returns:
+        dict: cp_ids, offsets, cells and points arrays, None if there is no valid store
+    """
+    if not os.path.exists(prefix + '_key.npy') or \
+            not os.path.exists(prefix + '_points_file.npy'):
+        return None
+    if key is not None and str(np.load(prefix + '_key.npy')) != key:
+        return None
+    pts_file = str(np.load(prefix + '_points_file.npy'))
+    if not os.path.exists(pts_file):
+        return None
+    store = {name: np.load(prefix + '_' + name + '.npy', mmap_mode=mmap_mode)
+             for name in STORE_ARRAYS}
+    store['points'] = np.load(pts_file, mmap_mode=mmap_mode)
+    return store
+
+
+def geom_store(msc, dim, dir, points, msc_file=None, pers_thresh=None):
+    """Geometry store of msc, loaded from next to msc_file when there is one.
+
+    Args:
+        msc (msc object): Morse complex object, simplified with pers_thresh
+        dim (int): critical point type
+        dir (int): 0 -- descending, 1 -- ascending
+        points (str): "primal" or "dual", the points the cells index into
+        msc_file (str, optional): file the unsimplified msc is saved in, None to keep
+            the store in memory. Defaults to None.
+        pers_thresh (float, optional): threshold msc is simplified with. Defaults to None.
+
+    Description:
+        Without msc_file the store is only built in memory. With it, a store of the
+        same msc file and the same surviving critical points is memory-mapped,
+        otherwise the store is built and saved for the later stages and reruns, its
+        size is logged. The points are saved once per msc file.
+
+    Returns:
+        dict: cp_ids, offsets, cells and points arrays
+        str: prefix of the saved store, None without msc_file
+    """
+    if msc_file is None:
+        return build_geom_store(msc, dim, dir, points), None
+
+    prefix = store_prefix(msc_file, dim, dir, pers_thresh)
+    file_key = msc_file_key(msc_file)
+    pts_file = save_points(msc, points, msc_file, file_key)
+    # msc may be simplified further than pers_thresh, e.g. by a sweep
+    key = '%s-%s' % (file_key, cps_key(msc, dim))
+    store = load_geom_store(prefix, key)
+    if store is None:
+        save_geom_store(prefix, key, build_geom_store(msc, dim, dir), pts_file)
+        store = load_geom_store(prefix, key)
+    return store, prefix
+
+
+def open_geom_store(src):
+    """Geometry store from a prefix or an in-memory store.
+
+    Args:
+        src (str or dict): prefix of a saved store, or the store itself
+
+    Returns:
+        dict: cp_ids, offsets, cells and points arrays
+    """
+    return load_geom_store(src) if isinstance(src, str) else src
+
+
+def cp_rows(store, cps):
+    """Rows of critical points in a store.
+
+    Args:
+        store (dict): geometry store
+        cps (np array): critical point ids
+
+    Returns:
+        np array: index of every critical point in store['cp_ids']
+    """
+    cp_ids, cps = np.asarray(store['cp_ids']), np.asarray(cps, dtype=np.int64)
+    sorter = np.argsort(cp_ids, kind='stable')
+    pos = np.searchsorted(cp_ids, cps, sorter=sorter)
+    rows = sorter[np.minimum(pos, max(len(cp_ids) - 1, 0))] if len(cp_ids) else pos
+    if not np.array_equal(cp_ids[rows], cps):
+        raise KeyError("Critical points missing from the geometry store")
+    return rows
+
+
+def cp_geom(store, row):
+    """Cells of the critical point in a row of the store.
+
+    Args:
+        store (dict): geometry store
+        row (int): row of the critical point
+
+    Returns:
+        np array: cells of the critical point
+    """
+    offsets = store['offsets']
+    return store['cells'][offsets[row]:offsets[row + 1]]
+
+
+def rows_geom(store, rows):
+    """Cells of several critical points at once.
+
+    Args:
+        store (dict): geometry store
+        rows (np array): rows of the critical points
+
+    Returns:
+        np array: concatenated cells of the critical points
+        np array: number of cells of every critical point
+    """
+    offsets = store['offsets']
+    rows = np.asarray(rows, dtype=np.int64)
+    starts, lens = offsets[rows], offsets[rows + 1] - offsets[rows]
+    # position of every cell in store['cells']
+    idx = np.arange(lens.sum()) + np.repeat(starts - np.cumsum(lens) + lens, lens)
+    return np.asarray(store['cells'][idx]), lens
@@ -0,0 +1,312 @@
+# import modules
+import numpy as np
+
+# Intensity histogram of an integer image, computed once in slabs, and the
+# quantiles, contrast stretch and global thresholds derived from it. The
+# thresholds rebin the histogram as the SimpleITK filters do and return the
+# same values.
+
+# number of bins of a uint16 image, one per intensity value
+NUM_BINS = 2 ** 16
+# bins of the SimpleITK Otsu filter, the other threshold filters use 256
+OTSU_BINS = 128
+
+
+def image_histogram(arr, slab_size=64):
+    """Histogram of an unsigned integer image with one bin per intensity value.
+
+    Args:
+        arr (numpy array): uint8 or uint16 image, may be memory-mapped
+        slab_size (int, optional): slices along the first axis counted at a time.
+            Defaults to 64.
+
+    Raises:
+        ValueError: arr is not a uint8 or uint16 image
+
+    Returns:
+        numpy array: voxel count of every intensity value (int64)
+    """
+    if arr.dtype not in (np.uint8, np.uint16):
+        raise ValueError('histogram of a %s image' % arr.dtype)
+    hist = np.zeros(2 ** (8 * arr.dtype.itemsize), dtype=np.int64)
+    for i in range(0, arr.shape[0], slab_size):
+        hist += np.bincount(arr[i:i + slab_size].ravel(), minlength=len(hist))
+    return hist
+
+
+def remap_histogram(hist, lut):
+    """Histogram of the image after mapping its intensities through a lookup table.
+
+    Args:
+        hist (numpy array): histogram of the image
+        lut (numpy array): new intensity of every intensity value
+
+    Returns:
+        numpy array: histogram of the mapped image
+    """
+    return np.bincount(lut, weights=hist,
+                       minlength=2 ** (8 * lut.dtype.itemsize)).astype(np.int64)
+
+
+def _lerp(a, b, t):
+    """Linear interpolation in the same way as np.quantile."""
+    diff_b_a = b - a
+    return np.where(t >= 0.5, b - diff_b_a * (1 - t), a + diff_b_a * t)
+
+
+def hist_quantile(hist, q):
+    """Quantiles of the image from its histogram.
+
+    Args:
+        hist (numpy array): histogram of the image
+        q (float or array): quantiles in [0, 1]
+
+    Description:
+        Same values as np.quantile(arr, q) with the default linear method.
+
+    Returns:
+        float or numpy array: quantiles
+    """
+    q = np.asarray(q, dtype=np.float64)
+    cum = np.cumsum(hist)
+    index = (cum[-1] - 1) * q
+    lo = np.floor(index)
+    # value at a position of the sorted image
+    lo_val = np.searchsorted(cum, lo, side='right').astype(np.float64)
+    hi_val = np.searchsorted(cum, np.minimum(lo + 1, cum[-1] - 1), side='right')
+    return _lerp(lo_val, hi_val.astype(np.float64), index - lo)[()]
+
+
+def stretch_lut(low, upp, dtype=np.uint16):
+    """Lookup table of the linear contrast stretch (imadjust).
+
+    Args:
+        low (float): intensity mapped to 0
+        upp (float): intensity mapped to 2**16 - 1
+        dtype (numpy dtype, optional): type of the image. Defaults to np.uint16.
+
+    Returns:
+        numpy array: new intensity of every intensity value
+    """
+    val = np.arange(2 ** (8 * np.dtype(dtype).itemsize))
+    lut = (2**16 - 1) * (val - low) / (upp - low)
+    return (np.clip(lut, 0, 2**16-1)).astype(dtype)
+
+
+def apply_lut(arr, lut, slab_size=64):
+    """Map the intensities of the image through a lookup table, in place.
+
+    Args:
+        arr (numpy array): uint8 or uint16 image
+        lut (numpy array): new intensity of every intensity value, same type as arr
+        slab_size (int, optional): slices along the first axis mapped at a time.
+            Defaults to 64.
+    """
+    for i in range(0, arr.shape[0], slab_size):
+        slab = arr[i:i + slab_size]
+        np.take(lut, slab, out=slab)
+
+
+def contrast_stretch(arr, low_q=0.01, upp_q=0.99, hist=None):
+    """Stretch the intensities between two quantiles to the full range, in place.
+
+    Args:
+        arr (numpy array): image
+        low_q (float, optional): quantile mapped to 0. Defaults to 0.01.
+        upp_q (float, optional): quantile mapped to 2**16 - 1. Defaults to 0.99.
+        hist (numpy array, optional): histogram of arr. Defaults to None.
+
+    Description:
+        uint8 and uint16 images are mapped through a lookup table built from the
+        histogram, without float copies of the image. Other images fall back to
+        np.quantile and a float rescale.
+
+    Returns:
+        numpy array: histogram of the stretched image, None for other images
+    """
+    if arr.dtype not in (np.uint8, np.uint16):
+        low, upp = np.quantile(arr, low_q), np.quantile(arr, upp_q)
+        arr[...] = np.clip((2**16 - 1) * (arr - low) / (upp - low), 0, 2**16-1)
+        return None
+
+    if hist is None:
+        hist = image_histogram(arr)
+    low, upp = hist_quantile(hist, [low_q, upp_q])
+    lut = stretch_lut(low, upp, arr.dtype)
+    apply_lut(arr, lut)
+    return remap_histogram(hist, lut)
+
+
+def itk_histogram(hist, num_bins=256):
+    """Rebin a histogram the way the SimpleITK threshold filters bin the image.
+
+    Args:
+        hist (numpy array): histogram of the image (see image_histogram)
+        num_bins (int, optional): number of bins. Defaults to 256.
+
+    Description:
+        uint8 images are binned over [0, 256). Other images are binned from their
+        minimum to their maximum, with the upper bound raised by a hundredth of a
+        bin. The bin bounds are computed in single precision, as in ITK. The
+        thresholds below follow the ITK calculators on these bins; only Li can end a
+        level or two apart when the bins are narrower than one intensity level, which
+        a stretched uint16 image never has.
+
+    Returns:
+        tuple: counts (float64), centres, lower and upper bounds of the bins
+    """
+    nonzero = np.flatnonzero(hist)
+    if len(hist) == 2 ** 8:
+        low, upp = 0.0, 256.0
+    else:
+        low, upp = float(nonzero[0]), float(nonzero[-1])
+        upp += (upp - low) / num_bins / 100.0
+    interval = np.float32((upp - low) / num_bins)
+    index = np.arange(num_bins, dtype=np.float32)
+    mins = low + (index * interval).astype(np.float64)
+    maxs = low + ((index + 1) * interval).astype(np.float64)
+    maxs[-1] = upp
+    bins = np.searchsorted(mins, nonzero, side='right') - 1
+    counts = np.bincount(bins, weights=hist[nonzero], minlength=num_bins)
+    return counts, (mins + maxs) / 2, mins, maxs
+
+
+def threshold_isodata(hist):
+    """IsoData threshold, the first occupied bin above the midpoint of the means below
+    and above it.
+
+    Args:
+        hist (numpy array): histogram of the image
+
+    Returns:
+        float: threshold, foreground is above it
+    """
+    counts, centres, _, _ = itk_histogram(hist)
+    csum = np.cumsum(counts)
+    isum = np.cumsum(counts * centres)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mid = (isum / csum + (isum[-1] - isum) / (csum[-1] - csum)) / 2
+    found = (counts > 0) & (csum > 0) & (csum[-1] - csum > 0) & (centres >= mid)
+    # the search starts past the first occupied bin after bin 0 (ImageJ)
+    occupied = np.flatnonzero(counts[1:])
+    found[:occupied[0] + 2 if len(occupied) else 0] = False
+    found[len(counts) - 1:] = False
+    if not found.any():
+        return np.trunc(isum[-1] / csum[-1])
+    return np.trunc(centres[np.argmax(found)])
+
+
+def threshold_li(hist):
+    """Li's iterative minimum cross entropy threshold.
+
+    Args:
+        hist (numpy array): histogram of the image
+
+    Returns:
+        float: threshold, foreground is above it
+    """
+    counts, centres, mins, _ = itk_histogram(hist)
+    csum = np.cumsum(counts)
+    isum = np.cumsum(counts * centres)
+    # the initial mean leaves out bin 0 (ImageJ)
+    new_thresh = (isum[-1] - isum[0]) / csum[-1]
+    while True:
+        old_thresh = new_thresh
+        thresh = int(np.clip(np.searchsorted(mins, old_thresh, side='right') - 1,
+                             0, len(counts) - 1))
+        mean_back = isum[thresh] / csum[thresh] if csum[thresh] else 0.0
+        num_obj = csum[-1] - csum[thresh]
+        mean_obj = (isum[-1] - isum[thresh]) / num_obj if num_obj else 0.0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            temp = (mean_back - mean_obj) / (np.log(mean_back) - np.log(mean_obj))
+        if not np.isfinite(temp):
+            break
+        # rounded to the nearest integer as in ImageJ
+        new_thresh = float(int(temp - 0.5) if temp < -2.220446049250313e-16
+                           else int(temp + 0.5))
+        if abs(new_thresh - old_thresh) <= 0.5:
+            break
+    return np.trunc(centres[thresh])
+
+
+def threshold_otsu(hist):
+    """Otsu's threshold, maximizing the variance between the two classes.
+
+    Args:
+        hist (numpy array): histogram of the image
+
+    Returns:
+        float: threshold, foreground is above it
+    """
+    counts, centres, _, maxs = itk_histogram(hist, OTSU_BINS)
+    weight1 = np.cumsum(counts)[:-1]
+    weight2 = counts.sum() - weight1
+    sum1 = np.cumsum(counts * centres)[:-1]
+    sum2 = np.sum(counts * centres) - sum1
+    with np.errstate(invalid='ignore', divide='ignore'):
+        variance12 = np.where((weight1 > 0) & (weight2 > 0),
+                              sum1 ** 2 / weight1 + sum2 ** 2 / weight2, -np.inf)
+    # upper bound of the bin, the uint8 bins end on an intensity of the next bin
+    upper = maxs[np.argmax(variance12)]
+    return upper - 1 if len(hist) == 2 ** 8 else np.trunc(upper)
+
+
+def threshold_triangle(hist):
+    """Triangle threshold, farthest bin from the line from the peak to the farther of
+    the 1% and 99% levels.
+
+    Args:
+        hist (numpy array): histogram of the image
+
+    Returns:
+        float: threshold, foreground is above it
+    """
+    counts, centres, _, _ = itk_histogram(hist)
+    arg_peak = int(np.argmax(counts))
+    peak_height = counts[arg_peak]
+    cum = np.cumsum(counts)
+    arg_low = int(np.argmax(cum > cum[-1] / 100))
+    arg_high = int(np.argmax(cum > cum[-1] * 99 / 100))
+
+    if abs(arg_peak - arg_low) > abs(arg_peak - arg_high):
+        bins = np.arange(arg_low, arg_peak)
+        line = peak_height / (arg_peak - arg_low) * (bins - arg_low)
+    else:
+        bins = np.arange(arg_peak, arg_high)
+        line = -peak_height / (arg_high - arg_peak) * (bins - arg_peak) + peak_height
+    if len(bins) == 0:
+        return np.trunc(centres[arg_peak])
+    # the line is evaluated in single precision as in ITK
+    arg_level = bins[np.argmax(line.astype(np.float32) - counts[bins])]
+    return np.trunc(centres[min(arg_level + 1, len(counts) - 1)])
+
+
+def threshold_yen(hist):
+    """Yen's threshold, maximizing the entropic correlation of the two classes.
+
+    Args:
+        hist (numpy array): histogram of the image
+
+    Returns:
+        float: threshold, foreground is above it
+    """
+    counts, centres, _, _ = itk_histogram(hist)
+    pmf = counts / counts.sum()
+    P1 = np.cumsum(pmf)
+    P1_sq = np.cumsum(pmf ** 2)
+    P2_sq = np.append(np.cumsum(pmf[::-1] ** 2)[::-1][1:], 0.0)
+    P12_sq, P1_P2 = P1_sq * P2_sq, P1 * (1.0 - P1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        crit = (-np.where(P12_sq > 0, np.log(P12_sq), 0.0) +
+                2 * np.where(P1_P2 > 0, np.log(P1_P2), 0.0))
+    return np.trunc(centres[np.argmax(crit)])
+
+
+# thresholds by the filter names of bd_extraction
+HIST_THRESHOLDS = dict(
+    Isodata=threshold_isodata,
+    Li=threshold_li,
+    Otsu=threshold_otsu,
+    Triangle=threshold_triangle,
+    Yen=threshold_yen,
+)
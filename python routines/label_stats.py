@@ -0,0 +1,188 @@
+# import modules
+import numba
+from numba import jit
+import numpy as np
+
+# Per label statistics of a segmentation, computed for all the labels at once
+# from the label volume and the distance field.
+
+# columns of the csv table, in order
+CSV_COLUMNS = ['label', 'count',
+               'centroid_x', 'centroid_y', 'centroid_z',
+               'bbox_min_x', 'bbox_min_y', 'bbox_min_z',
+               'bbox_max_x', 'bbox_max_y', 'bbox_max_z',
+               'dist_max', 'dist_mean', 'dist_range',
+               'inertia_xx', 'inertia_yy', 'inertia_zz',
+               'inertia_xy', 'inertia_xz', 'inertia_yz',
+               'eig_val_1', 'eig_val_2', 'eig_val_3',
+               'axis_1_x', 'axis_1_y', 'axis_1_z',
+               'axis_2_x', 'axis_2_y', 'axis_2_z',
+               'axis_3_x', 'axis_3_y', 'axis_3_z']
+
+
+@jit(nopython=True, parallel=True)
+def _mark_labels(seg, present):
+    """Flag the labels that occur in the volume.
+
+    Args:
+        seg (numpy array): label volume
+        present (numpy array): flags of the labels, set in place
+    """
+    nx, ny, nz = seg.shape
+    for x in numba.prange(nx):
+        for y in range(ny):
+            for z in range(nz):
+                present[seg[x, y, z]] = True
+
+
+def compact_lut(seg):
+    """Lookup table from the labels of a volume to 0..n-1.
+
+    Args:
+        seg (numpy array): label volume
+
+    Description:
+        Cp ids and other sparse labels can be far larger than the number of labels,
+        the table costs 5 bytes per possible label while the per label accumulators
+        are sized by the labels that actually occur.
+
+    Returns:
+        numpy array: labels present in the volume, sorted (n,)
+        numpy array: lookup table giving the index of every label in the first array
+    """
+    present = np.zeros(int(seg.max(initial=0)) + 1, dtype=np.bool_)
+    _mark_labels(seg, present)
+    lut = np.cumsum(present, dtype=np.int32) - 1
+    return np.flatnonzero(present), lut
+
+
+@jit(nopython=True, parallel=True)
+def _accumulate(seg, dist, lut, counts, moments, dist_sum, bbox_min, bbox_max,
+                dist_min, dist_max):
+    """Accumulate the per label sums and extrema in one pass over the volume.
+
+    Args:
+        seg (numpy array): label volume
+        dist (numpy array): distance field
+        lut (numpy array): index of every label in the accumulators
+        counts (numpy array): voxel count of every label (num_threads, num_labels)
+        moments (numpy array): sums of x, y, z, xx, yy, zz, xy, xz, yz
+            (num_threads, num_labels, 9)
+        dist_sum (numpy array): sum of the distance values (num_threads, num_labels)
+        bbox_min (numpy array): lower corner of the bounding box (num_threads, num_labels, 3)
+        bbox_max (numpy array): upper corner of the bounding box (num_threads, num_labels, 3)
+        dist_min (numpy array): minimum distance value (num_threads, num_labels)
+        dist_max (numpy array): maximum distance value (num_threads, num_labels)
+
+    Description:
+        Every thread accumulates a block of x-slices into its own row of the
+        accumulators, the rows are reduced by the caller.
+    """
+    nx, ny, nz = seg.shape
+    num_threads = counts.shape[0]
+    for t in numba.prange(num_threads):
+        for x in range(t * nx // num_threads, (t + 1) * nx // num_threads):
+            for y in range(ny):
+                for z in range(nz):
+                    lab = lut[seg[x, y, z]]
+                    val = dist[x, y, z]
+                    counts[t, lab] += 1
+                    moments[t, lab, 0] += x
+                    moments[t, lab, 1] += y
+                    moments[t, lab, 2] += z
+                    moments[t, lab, 3] += x * x
+                    moments[t, lab, 4] += y * y
+                    moments[t, lab, 5] += z * z
+                    moments[t, lab, 6] += x * y
+                    moments[t, lab, 7] += x * z
+                    moments[t, lab, 8] += y * z
+                    dist_sum[t, lab] += val
+                    bbox_min[t, lab, 0] = min(bbox_min[t, lab, 0], x)
+                    bbox_min[t, lab, 1] = min(bbox_min[t, lab, 1], y)
+                    bbox_min[t, lab, 2] = min(bbox_min[t, lab, 2], z)
+                    bbox_max[t, lab, 0] = max(bbox_max[t, lab, 0], x)
+                    bbox_max[t, lab, 1] = max(bbox_max[t, lab, 1], y)
+                    bbox_max[t, lab, 2] = max(bbox_max[t, lab, 2], z)
+                    dist_min[t, lab] = min(dist_min[t, lab], val)
+                    dist_max[t, lab] = max(dist_max[t, lab], val)
+
+
+def compute_label_stats(seg, dist):
+    """Statistics of every label of a segmentation.
+
+    Args:
+        seg (numpy array): label volume, 0 is the background
+        dist (numpy array): distance field of the same shape
+
+    Description:
+        The labels are first mapped to 0..n-1 with compact_lut, then all the sums and
+        extrema are accumulated in a single parallel compiled pass over the voxels, the
+        coordinate moments in exact integer arithmetic. The inertia is the
+        covariance matrix of the voxel coordinates of a label, the principal axes are
+        its eigenvectors sorted by decreasing eigenvalue.
+
+    Returns:
+        dict: label (n,), count (n,), centroid (n, 3), bbox_min (n, 3), bbox_max (n, 3),
+            dist_max (n,), dist_mean (n,), dist_range (n,), inertia (n, 3, 3),
+            eig_vals (n, 3) and axes (n, 3, 3) with the axes in the rows
+    """
+    if seg.shape != dist.shape:
+        raise ValueError("Label volume and distance field differ in shape: "
+                         f"{seg.shape} and {dist.shape}")
+    labels, lut = compact_lut(seg)
+    num_labels = len(labels)
+    num_threads = max(1, min(numba.get_num_threads(), seg.shape[0]))
+
+    counts = np.zeros((num_threads, num_labels), dtype=np.int64)
+    moments = np.zeros((num_threads, num_labels, 9), dtype=np.int64)
+    dist_sum = np.zeros((num_threads, num_labels))
+    bbox_min = np.full((num_threads, num_labels, 3), np.iinfo(np.int64).max)
+    bbox_max = np.full((num_threads, num_labels, 3), -1)
+    dist_min = np.full((num_threads, num_labels), np.inf)
+    dist_max = np.full((num_threads, num_labels), -np.inf)
+    _accumulate(seg, dist, lut, counts, moments, dist_sum, bbox_min, bbox_max,
+                dist_min, dist_max)
+    counts, moments, dist_sum = counts.sum(0), moments.sum(0), dist_sum.sum(0)
+    bbox_min, bbox_max = bbox_min.min(0), bbox_max.max(0)
+    dist_min, dist_max = dist_min.min(0), dist_max.max(0)
+
+    # without the background
+    keep = np.flatnonzero(labels != 0)
+    label = labels[keep]
+    cnt = counts[keep].astype(np.float64)
+    mean = moments[keep, :3] / cnt[:, np.newaxis]
+    second = moments[keep, 3:] / cnt[:, np.newaxis]
+
+    inertia = np.empty((len(label), 3, 3))
+    for k, (i, j) in enumerate(((0, 0), (1, 1), (2, 2), (0, 1), (0, 2), (1, 2))):
+        inertia[:, i, j] = inertia[:, j, i] = second[:, k] - mean[:, i] * mean[:, j]
+    eig_vals, eig_vecs = np.linalg.eigh(inertia)
+
+    return dict(label=label, count=counts[keep], centroid=mean,
+                bbox_min=bbox_min[keep], bbox_max=bbox_max[keep],
+                dist_max=dist_max[keep], dist_mean=dist_sum[keep] / cnt,
+                dist_range=dist_max[keep] - dist_min[keep], inertia=inertia,
+                eig_vals=eig_vals[:, ::-1],
+                axes=eig_vecs[:, :, ::-1].transpose(0, 2, 1))
+
+
+def save_label_stats(stats, file_name):
+    """Write the label statistics as a npz archive and a csv table.
+
+    Args:
+        stats (dict): output of compute_label_stats
+        file_name (str): output file name without extension
+    """
+    np.savez(file_name + '.npz', **stats)
+
+    inertia = stats['inertia']
+    table = np.column_stack([
+        stats['label'], stats['count'], stats['centroid'],
+        stats['bbox_min'], stats['bbox_max'],
+        stats['dist_max'], stats['dist_mean'], stats['dist_range'],
+        inertia[:, 0, 0], inertia[:, 1, 1], inertia[:, 2, 2],
+        inertia[:, 0, 1], inertia[:, 0, 2], inertia[:, 1, 2],
+        stats['eig_vals'], stats['axes'].reshape(-1, 9)])
+    fmt = ['%d', '%d'] + ['%.6g'] * 3 + ['%d'] * 6 + ['%.6g'] * (len(CSV_COLUMNS) - 11)
+    np.savetxt(file_name + '.csv', table, fmt=fmt, delimiter=',',
+               header=','.join(CSV_COLUMNS), comments='')
@@ -1,24 +1,27 @@
 # external and inbuilt modules
 import argparse
-from matplotlib import pyplot as plt
+from functools import partial
+import logging
 import numpy as np
 import os
-import vtk
 import tkinter as tk
 from tkinter.filedialog import askopenfilename
 
 # PYMS3d related modules
-from convert_store_data import write_polydata, write_img_from_arr
+from convert_store_data import BackgroundWriter, write_img_from_arr, write_labels_h5
+from label_stats import compute_label_stats, save_label_stats
 from persistence_calculation import compute_pers_diagm
+from polydata_utils import build_polydata, to_vtk_array, vert_cells
 import pyms3d_core as pyms3d
-from utilities import bimode_log_min, check_segmentation
+from utilities import check_segmentation, clean_segmentation
 from utilities import get_dims, read_msc_to_img
 from utilities import get_saddles, compute_contact_regions
 from utilities import get_cp, get_extremum_graph
 from utilities import get_segmentation_index_dual
 import pandas as pd
 
-def disp_pers_curve(data_file_name, dim, msc_file_name, output_path_name, mode):
+def disp_pers_curve(data_file_name, dim, msc_file_name, output_path_name, mode,
+                    msc=None):
     '''
     Display the persistence curve
 
@@ -27,6 +30,8 @@ def disp_pers_curve(data_file_name, dim, msc_file_name, output_path_name, mode):
         dim (tuple): dimensions of distance field
         msc_file_name (str): name of the msc file
         output_path_name (str): path to store the output
+        msc (msc or str): unsimplified msc, or the file it is saved in, to use
+            instead of computing one on a cache miss
 
     Returns:
         float: persistence threshold
@@ -35,7 +40,9 @@ def disp_pers_curve(data_file_name, dim, msc_file_name, output_path_name, mode):
     # compute the persistence diagram and curve
     
     # get the persistence threshold
-    percent_pers = compute_pers_diagm(data_file_name, dim, mode)
+    percent_pers = compute_pers_diagm(
+        data_file_name, dim, mode, msc,
+        output_path_name + msc_file_name + '_pers.npz')
     if mode == "manual":
         percent_pers = float(input("enter the knee point : "))
     else:
@@ -72,14 +79,17 @@ def initial_msc(data_file_name, dim, msc_file_name, output_path_name):
     return msc
 
 
-def simplify_msc(dim, percent_pers, msc):
+def simplify_msc(writer, dim, percent_pers, msc, msc_path=None):
     '''
     Simplify the msc
 
     Args:
+        writer (BackgroundWriter): writer of the outputs
         dim (tuple): dimensions of distance field
         percent_pers (float): persistence threshold
         msc (msc): initial msc
+        msc_path (str): file the initial msc is saved in, the geometry stores of
+            the worker pools are saved next to it; None keeps them in memory
 
     Returns:
         img: msc vert function to image
@@ -88,72 +98,97 @@ def simplify_msc(dim, percent_pers, msc):
         # msc vert function to image
     img = read_msc_to_img(msc, dim)
         # simplify mscomplex with manually selected threshold
+    # no writes may be running while the worker pool forks
+    writer.flush()
+    _, all_saddles, all_maxima = compute_contact_regions(msc, img, False,
+                                                         msc_file=msc_path)
+    print('compute contact regions done')
     print('Writing Critical Points : (3)')
-    write_polydata(get_cp(msc, 3), "../Outputs/cps_3.vtp")
+    writer.write_polydata(get_cp(msc, 3), "../Outputs/cps_3.vtp")
     print('Writing Critical Points : (2)')
-    write_polydata(get_cp(msc, 2), "../Outputs/cps_2.vtp")
-    _, all_saddles = compute_contact_regions(msc, img, False)
-    print('compute contact regions done')
-    all_contacts, _ = get_saddles(msc, all_saddles)
+    writer.write_polydata(get_cp(msc, 2), "../Outputs/cps_2.vtp")
+    all_contacts, _ = get_saddles(msc, all_saddles, sad_maxima=all_maxima)
     print('Writing All Contacts')
-    write_polydata(all_contacts, output_path_name +
+    writer.write_polydata(all_contacts, output_path_name +
                        base_name + '_contacts_all.vtp')
     msc.simplify_pers(thresh=percent_pers, is_nrm=False)
 
     print('MSC Simplified')
+    writer.flush('simplify')
     return img
 
 
-def compute_contact_reg(base_name, output_path_name, msc, img):
+def compute_contact_reg(writer, base_name, output_path_name, msc, img,
+                        msc_path=None, percent_pers=None, simplified_network=False):
     '''
     Compute the contact regions
 
     Args:
+        writer (BackgroundWriter): writer of the outputs
         base_name (str): base name of the output
         output_path_name (str): path to store the output
         msc (msc): initial msc
         img (img): msc vert function to image
+        msc_path (str): file the initial msc is saved in, the geometry stores of
+            the worker pools are saved next to it; None keeps them in memory
+        percent_pers (float): persistence threshold msc was simplified with
+        simplified_network (bool): also write the max-saddle-max network
 
     Returns:
-        maxs (list): list of maxima
+        maxs (np array): sorted ids of the maxima connected by contacts
     '''
 
 
     print('Computing Contact Regions')
+    writer.flush()
         # remove saddles that lie in the backgraound
         # also remove the voxels of descending manifold in the background
-    des_man, surv_sads = compute_contact_regions(msc, img)  # issues
+    des_man, surv_sads, sad_maxima = compute_contact_regions(
+        msc, img, msc_file=msc_path, pers_thresh=percent_pers)  # issues
     print('Contact Regions Extracted')
         # contacts from surviving saddles
-    contacts, maxs = get_saddles(msc, surv_sads)
+    contacts, maxs = get_saddles(msc, surv_sads, output_path_name +
+                                 base_name + '_contacts.npz', sad_maxima)
     print('Contacts Computed')
         # grain centers in critical point cell ids
     grain_centres = get_cp(msc, 3)
     print('Grain Centres Computed')
         # connectivity network
-    connectivity_network = get_extremum_graph(msc, surv_sads)
+    connectivity_network = get_extremum_graph(msc, surv_sads, msc_file=msc_path,
+                                              pers_thresh=percent_pers)
     print('Connectivity Network Computed')
-    write_polydata(grain_centres, output_path_name +
+    writer.write_polydata(grain_centres, output_path_name +
                        base_name + '_grain_centres.vtp')
-    write_polydata(contacts, output_path_name +
+    writer.write_polydata(contacts, output_path_name +
                        base_name + '_contacts.vtp')
-    write_polydata(des_man, output_path_name +
+    writer.write_polydata(des_man, output_path_name +
                        base_name + '_contact_regions.vtp')
-    write_polydata(connectivity_network, output_path_name + base_name +
+    writer.write_polydata(connectivity_network, output_path_name + base_name +
                        '_connectivity_network.vtp')
-                   
+    if simplified_network:
+        writer.write_polydata(get_extremum_graph(msc, surv_sads, simplified=True,
+                                                 sad_maxima=sad_maxima),
+                       output_path_name + base_name +
+                       '_connectivity_network_simplified.vtp')
+    writer.flush('contact regions')
     return maxs
 
 
-def compute_seg(base_name, output_path_name, msc, img):
+def compute_seg(writer, base_name, output_path_name, msc, img, msc_path=None,
+                percent_pers=None, export_grains=False):
     '''
     Compute the segmentation
 
     Args:
+        writer (BackgroundWriter): writer of the outputs
         base_name (str): base name of the output
         output_path_name (str): path to store the output
         msc (msc): initial msc
         img (img): msc vert function to image
+        msc_path (str): file the initial msc is saved in, the geometry stores of
+            the worker pools are saved next to it; None keeps them in memory
+        percent_pers (float): persistence threshold msc was simplified with
+        export_grains (bool): also write a vtp file per grain (vtp output)
 
     Returns:
         segmentation (vtp): segmentation
@@ -172,26 +207,116 @@ def compute_seg(base_name, output_path_name, msc, img):
         rind = 1
 
     rtype = "VTP" if (rind == 0) else "NP"
+    writer.flush()
 
     if rind == 0:
-        segmentation = get_segmentation_index_dual(msc, img, rtype)
-        write_polydata(segmentation, output_path_name +
+        segmentation = get_segmentation_index_dual(
+            msc, img, rtype, msc_path, percent_pers,
+            output_path_name + 'grains/' if export_grains else None)
+        writer.write_polydata(segmentation, output_path_name +
                            base_name + '_segmentation.vtp')
     else:
         segmentation, centers, maximas, labs, vols = \
-                get_segmentation_index_dual(msc, img, rtype)
+                get_segmentation_index_dual(msc, img, rtype, msc_path, percent_pers)
     print('Segmentation Computed')
+    writer.flush('segmentation')
     return segmentation,centers,maximas,labs,vols
 
 
+def threshold_sweep(writer, base_name, output_path_name, msc, msc_path, dim,
+                    thresholds, write_seg=False, num_bins=50, seg_format='mhd'):
+    '''
+    Segment with several persistence thresholds from one complex
+
+    Args:
+        writer (BackgroundWriter): writer of the outputs
+        base_name (str): base name of the output
+        output_path_name (str): path to store the output
+        msc (msc): initial msc, it is simplified in place
+        msc_path (str): file the initial msc is saved in, the geometry stores of
+            the worker pools are saved next to it; None keeps them in memory
+        dim (tuple): dimensions of distance field
+        thresholds (list): persistence thresholds
+        write_seg (bool): write the segmentation of every threshold
+        num_bins (int): number of log spaced volume histogram bins
+        seg_format (str): 'mhd' or 'h5' (chunked, compressed) segmentation files
+
+    Returns:
+        dict: thresholds, grain and contact counts and volume histograms
+    '''
+    img = read_msc_to_img(msc, dim)
+    thresholds = np.sort(np.asarray(thresholds, dtype=float))
+    # volume bins shared by all levels -- from one voxel to the whole volume
+    edges = np.logspace(0, np.log10(img.size), num_bins + 1)
+    grains, contacts, segmented, hists = [], [], [], []
+
+    for thresh in thresholds:
+        print("Simplifying to persistence threshold: ", thresh)
+        # the complex is simplified further for every (ascending) threshold
+        msc.simplify_pers(thresh=thresh, is_nrm=False)
+        grains.append(int(np.sum(msc.cps_func()[msc.cps(3)] > 0)))
+        # the segmentation of the last threshold is written while simplifying
+        writer.flush()
+        _, surv_sads, _ = compute_contact_regions(msc, img, False, msc_file=msc_path,
+                                                  pers_thresh=thresh)
+        contacts.append(len(surv_sads))
+
+        seg, _, _, _, vols = get_segmentation_index_dual(msc, img, "NP", msc_path,
+                                                         thresh)
+        segmented.append(len(vols))
+        hists.append(np.histogram(vols, bins=edges)[0])
+        if write_seg:
+            write_seg_file = write_labels_h5 if seg_format == 'h5' \
+                else write_img_from_arr
+            writer.submit(write_seg_file, output_path_name + base_name +
+                          '_Segmentation_%g' % thresh, seg)
+        print(f'Grains: {grains[-1]}, contacts: {contacts[-1]}, '
+              f'segmented: {segmented[-1]}')
+
+    sweep = dict(thresholds=thresholds, grains=np.array(grains),
+                 contacts=np.array(contacts), segmented=np.array(segmented),
+                 vol_hist=np.array(hists).reshape(-1, num_bins), vol_bins=edges)
+    np.savez(output_path_name + base_name + '_sweep.npz', **sweep)
+    pd.DataFrame({k: sweep[k] for k in
+                  ('thresholds', 'grains', 'contacts', 'segmented')}).to_csv(
+        output_path_name + base_name + '_sweep.csv', index=False)
+    writer.flush('sweep')
+    return sweep
+
+
 if __name__ == "__main__":
     # get the arguments from command line -- data_file
     parser = argparse.ArgumentParser()
     parser.add_argument('data_file', type=str, help='raw distance field file name')
-    parser.add_argument('--mode', type=str, help='automatic / manual pipeline', required=False, default="manual")
+    parser.add_argument('--mode', type=str, help='automatic / manual / sweep pipeline', required=False, default="manual")
+    parser.add_argument('--thresholds', type=float, nargs='+',
+                        help='persistence thresholds of the sweep mode')
+    parser.add_argument('--sweep-segmentation', action='store_true',
+                        help='write the segmentation of every sweep threshold')
+    parser.add_argument('--simplified-network', action='store_true',
+                        help='also write a max-saddle-max connectivity network')
+    parser.add_argument('--export-grains', action='store_true',
+                        help='also write a vtp file per grain to ../Outputs/grains')
+    parser.add_argument('--vol-cutoff', type=float,
+                        help='volume cutoff of the clean up (default: bimode_log_min)')
+    parser.add_argument('--compact-labels', action='store_true',
+                        help='renumber the labels to 1..n in the clean up')
+    parser.add_argument('--seg-format', choices=['mhd', 'h5'], default='mhd',
+                        help='segmentation file format, h5 is chunked and compressed')
+    parser.add_argument('--pieces', type=int, default=1,
+                        help='write polydata with a million points or more as this many '
+                             'pieces with a .pvtp index')
+    parser.add_argument('--split', choices=['id', 'spatial'], default='id',
+                        help='split the pieces by cell id ranges or spatial slabs')
+    parser.add_argument('--store-geometry', action='store_true',
+                        help='save the manifolds of every threshold next to the msc, '
+                             'reruns memory-map them')
 
     # capture the arguments in args
     args = parser.parse_args()
+    # writes the outputs while the pipeline continues, flushed before the worker
+    # pools fork and after every stage
+    writer = BackgroundWriter(num_pieces=args.pieces, split=args.split)
     data_file_name, dim = args.data_file, get_dims(args.data_file)
 
     # get the base name for storing other variables
@@ -203,17 +328,51 @@ if __name__ == "__main__":
     output_path_name = '../Outputs/'
     if not os.path.exists(output_path_name):
         os.makedirs(output_path_name)
-    
+    # the output writer logs the time of every file here
+    logging.basicConfig(filename=output_path_name + base_name + '_run.log',
+                        level=logging.INFO, format='%(asctime)s %(message)s')
+
+    # file of the msc the pipeline works on
+    msc_path = None
+    # the geometry stores are saved next to it with --store-geometry only, otherwise
+    # the worker pools inherit them in memory
+    store_path = None
+    # maxima of the contact network, kept by the clean up
+    maxs = None
+
     while(True):
         # this if statement is for the auto mode of the program
         if args.mode == "auto":
-            percent_pers = disp_pers_curve(data_file_name, dim, msc_file_name, output_path_name, args.mode)
+            # the gradient is computed once: the persistence curve works on
+            # a copy loaded from the saved initial msc (or on its cache)
             msc = initial_msc(data_file_name, dim, msc_file_name, output_path_name)
-            img = simplify_msc(dim, percent_pers, msc)
-            maxs = compute_contact_reg(base_name, output_path_name, msc, img)
-            segmentation = get_segmentation_index_dual(msc, img, "VTP")
-            write_polydata(segmentation, output_path_name +
+            msc_path = output_path_name + msc_file_name
+            store_path = msc_path if args.store_geometry else None
+            percent_pers = disp_pers_curve(data_file_name, dim, msc_file_name,
+                                           output_path_name, args.mode, msc_path)
+            img = simplify_msc(writer, dim, percent_pers, msc, store_path)
+            maxs = compute_contact_reg(writer, base_name, output_path_name, msc,
+                                       img, store_path, percent_pers,
+                                       args.simplified_network)
+            writer.flush()
+            segmentation = get_segmentation_index_dual(
+                msc, img, "VTP", store_path, percent_pers,
+                output_path_name + 'grains/' if args.export_grains else None)
+            writer.write_polydata(segmentation, output_path_name +
                             base_name + '_segmentation.vtp')
+            writer.flush('segmentation')
+            break
+
+        # segment with every threshold from a single complex
+        if args.mode == "sweep":
+            if not args.thresholds:
+                parser.error("--mode sweep needs --thresholds")
+            msc = initial_msc(data_file_name, dim, msc_file_name, output_path_name)
+            msc_path = output_path_name + msc_file_name
+            store_path = msc_path if args.store_geometry else None
+            threshold_sweep(writer, base_name, output_path_name, msc, store_path,
+                            dim, args.thresholds, args.sweep_segmentation,
+                            seg_format=args.seg_format)
             break
 
         print(pyms3d.select_device())
@@ -229,61 +388,49 @@ if __name__ == "__main__":
                         "9. Exit\n"))
 
         if (val == 1):
-            percent_pers = disp_pers_curve(data_file_name, dim, msc_file_name, output_path_name, args.mode)
+            # reuse the cached pairs or the stored initial msc if there is one
+            percent_pers = disp_pers_curve(data_file_name, dim, msc_file_name,
+                                           output_path_name, args.mode, msc_path)
         if (val == 2):
             msc = initial_msc(data_file_name, dim, msc_file_name, output_path_name)
+            msc_path = output_path_name + msc_file_name
+            store_path = msc_path if args.store_geometry else None
         if (val == 3):
-            img = simplify_msc(dim, percent_pers, msc)
+            img = simplify_msc(writer, dim, percent_pers, msc, store_path)
         if(val == 4):
-            maxs = compute_contact_reg(base_name, output_path_name, msc, img)
+            maxs = compute_contact_reg(writer, base_name, output_path_name, msc,
+                                       img, store_path, percent_pers,
+                                       args.simplified_network)
         if(val == 5):
-            segmentation, centers, maximas, labs, vols = compute_seg(base_name, output_path_name, msc, img)
+            segmentation, centers, maximas, labs, vols = compute_seg(
+                writer, base_name, output_path_name, msc, img, store_path,
+                percent_pers, args.export_grains)
 
         if (val == 6):
             print("Cleaning up the segmentation")
-            del_list = []
-            plt.figure()
-            plt.hist(np.log(vols), bins=30)
-            plt.show()
-
-            vol_cutoff = float(input('The cutoff value: '))  # bimode_log_min(vols)
-            # print(f'Volume cutoff is: {vol_cutoff}')
-            for ii, mid in enumerate(labs):
-                if (mid not in maxs) and (vols[ii] < vol_cutoff):
-                    segmentation[segmentation == mid] = 0
-                    del_list.append(ii)
-
-            print(f'Number of deleted labels: {len(del_list)}')
-            centers = [centers[ii]
-                    for ii in range(len(centers)) if ii not in del_list]
-            maximas = [maximas[ii]
-                    for ii in range(len(maximas)) if ii not in del_list]
-            labs = [labs[ii] for ii in range(len(labs)) if ii not in del_list]
-            vols = [vols[ii] for ii in range(len(vols)) if ii not in del_list]
-            print(f'Number of labels: {len(labs)}')
-
-            pa1, pa2, ia, fa = vtk.vtkPoints(), vtk.vtkPoints(),\
-                vtk.vtkIntArray(), vtk.vtkFloatArray()
-            ca = vtk.vtkCellArray()
-            ia.SetName("Label")
-            fa.SetName("Volume")
-            for i, (center, maxima, lab, vol)\
-                    in enumerate(zip(centers, maximas, labs, vols)):
-                pa1.InsertNextPoint(center)
-                pa2.InsertNextPoint(maxima)
-                ia.InsertNextValue(lab)
-                fa.InsertNextValue(vol)
-                ca.InsertNextCell(1)
-                ca.InsertCellPoint(i)
-            pd = vtk.vtkPolyData()
-            pd.SetPoints(pa2)
-            pd.SetVerts(ca)
-            pd.GetPointData().AddArray(ia)
-            pd.GetPointData().AddArray(fa)
-            write_polydata(pd, output_path_name +
+            segmentation, centers, maximas, labs, vols, cp_ids = \
+                clean_segmentation(segmentation, labs, maximas, maxs,
+                                   args.vol_cutoff, args.compact_labels)
+
+            point_data = [to_vtk_array(labs, "Label", np.int32),
+                          to_vtk_array(vols, "Volume", np.float32)]
+            if args.compact_labels:
+                point_data.append(to_vtk_array(cp_ids, "CP ID", np.int32))
+            pd = build_polydata(np.asarray(maximas, dtype=np.float32),
+                                verts=vert_cells(len(labs)), point_data=point_data)
+            writer.write_polydata(pd, output_path_name +
                         base_name + "_LabelProperties.vtp")
-            write_img_from_arr(
-                segmentation, output_path_name + base_name + '_Segmentation')
+            # volume, shape and distance statistics of every grain
+            stats = compute_label_stats(segmentation, img)
+            save_label_stats(stats, output_path_name + base_name + '_label_stats')
+            if args.seg_format == 'h5':
+                writer.submit(partial(write_labels_h5, stats=stats),
+                              output_path_name + base_name + '_Segmentation',
+                              segmentation)
+            else:
+                writer.write_img_from_arr(
+                    segmentation, output_path_name + base_name + '_Segmentation')
+            writer.flush('clean up')
 
         if (val == 7):
             print('Writing marked images in files: ', '( ', base_name, ' )')
@@ -301,6 +448,8 @@ if __name__ == "__main__":
             # file_name = input("Enter Path For Initial Morse-Smale Complex: \n")
             msc = pyms3d.mscomplex()
             msc.load(file_name)
+            msc_path = file_name
+            store_path = msc_path if args.store_geometry else None
             with open(output_path_name + msc_file_name + '.txt', 'r') as f:
                 percent_pers = float(f.read())
                 print("The last stored persistence threshold is: ", percent_pers)
@@ -309,3 +458,5 @@ if __name__ == "__main__":
         if (val == 9):
             print("exiting")
             break
+
+    writer.close()
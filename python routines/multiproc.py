@@ -1,64 +1,206 @@
+import itertools
 import vtk
 import numpy as np
+from multiprocessing import shared_memory
 from tqdm import tqdm
+from geom_store import cp_geom, cp_rows, open_geom_store, rows_geom
+from polydata_utils import build_polydata, to_vtk_array, vert_cells
 
 
-def get_vals(pt, arr_3d):
+# per-process state of a pool worker, filled once by the pool initializer
+_worker = {}
+
+
+def share_array(arr):
     '''
-    this function returns the values of the 8 points
-    surrounding the point pt
+    this function copies an array into a new shared memory block.
+    the caller owns the block and has to close and unlink it.
     Args:
-        pt (np.array): point
-        arr_3d (np.array): 3d array
+        arr (np.array): array to be shared
     Returns:
-        np.array: values of the 8 points surrounding the point pt
+        SharedMemory: shared memory block holding the array
+        tuple: (name, shape, dtype) spec to attach to the block
     '''
-    coords = []
-    for x_inc in [-0.5, 0.5]:
-        for y_inc in [-0.5, 0.5]:
-            for z_inc in [-0.5, 0.5]:
-                coords.append((int(pt[0] + x_inc), int(pt[1] + y_inc), int(pt[2] + z_inc)))
-    return np.array([arr_3d[coord] for coord in coords])
+    arr = np.asarray(arr)
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    shared = np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)
+    shared[...] = arr
+    return shm, (shm.name, arr.shape, arr.dtype.str)
 
 
-def save_grain_vtp(cp_id, msc, dp, img, ensem_dir):
+def attach_array(spec):
     '''
-    this function traverses the des_geom of a critical point and
-    saves the points in a vtp file
+    this function attaches to a shared memory block created by share_array
     Args:
-        cp_id (int): critical point id
-        msc (pyms3d.mscomplex): mscomplex object
+        spec (tuple): (name, shape, dtype) returned by share_array
+    Returns:
+        SharedMemory: attached shared memory block
+        np.array: array view on the shared memory block
+    '''
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def pack_shared(arrays):
+    '''
+    this function packs arrays one after the other into a new shared memory
+    block, to hand them to another process without pickling.
+    the block is closed here and has to be unlinked by unpack_shared.
+    Args:
+        arrays (list): numpy arrays
+    Returns:
+        tuple: (name, [(shape, dtype, offset), ...]) spec of the block
+    '''
+    arrays = [np.ascontiguousarray(arr) for arr in arrays]
+    layout, offset = [], 0
+    for arr in arrays:
+        layout.append((arr.shape, arr.dtype.str, offset))
+        offset += arr.nbytes
+    shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+    for arr, (shape, dtype, off) in zip(arrays, layout):
+        np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=off)[...] = arr
+    shm.close()
+    return shm.name, layout
+
+
+def unpack_shared(spec, out=None):
+    '''
+    this function copies the arrays of a block made by pack_shared and
+    unlinks the block.
+    Args:
+        spec (tuple): spec returned by pack_shared
+        out (list): arrays to copy into instead of new ones, optional
+    Returns:
+        list: numpy arrays
+    '''
+    name, layout = spec
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        if out is None:
+            out = [np.empty(shape, dtype=dtype) for shape, dtype, _ in layout]
+        for arr, (shape, dtype, off) in zip(out, layout):
+            arr[...] = np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=off)
+    finally:
+        shm.close()
+        shm.unlink()
+    return out
+
+
+def grain_points(des_geom, dp, img):
+    '''
+    this function traverses the des_geom of a critical point and returns
+    the dual points that do not lie completely in the background.
+    Args:
+        des_geom (np.array): dual point ids of the descending manifold
         dp (np.array): dual points
         img (np.array): distance field
-        ensem_dir (str): directory to save the vtp file
+    Returns:
+        np.array: dual points (n, 3)
+        np.array: distance value at each of the points
     '''
-    if(msc.cp_func(cp_id) <= 0):
-        return
+    dual_pts = dp[des_geom].reshape(-1, 3)
 
-    pa, cp_ids = vtk.vtkPoints(), vtk.vtkIntArray()
-    ca = vtk.vtkCellArray()
-    val = vtk.vtkFloatArray()
-    cp_ids.SetName("CP ID")
-    val.SetName('Distance Val')
+    # the 8 voxels surrounding each dual point
+    lo = (dual_pts - 0.5).astype(int)
+    hi = (dual_pts + 0.5).astype(int)
+    max_vals = np.full(len(dual_pts), -np.inf)
+    for x in (lo[:, 0], hi[:, 0]):
+        for y in (lo[:, 1], hi[:, 1]):
+            for z in (lo[:, 2], hi[:, 2]):
+                max_vals = np.maximum(max_vals, img[x, y, z])
+    surv = max_vals >= 0
+    return dual_pts[surv], img[lo[surv, 0], lo[surv, 1], lo[surv, 2]]
 
-    des_geom = msc.des_geom(cp_id)
-    for cube_id in des_geom:
-        dual_pt = dp[cube_id]
-        vals = get_vals(dual_pt, img)
-        if (max(vals) < 0):
-            continue
-        val.InsertNextValue(
-            img[int(dual_pt[0]), int(dual_pt[1]), int(dual_pt[2])])
-        pa.InsertNextPoint(dual_pt)
-        cp_ids.InsertNextValue(cp_id)
-        ca.InsertNextCell(1)
-        ca.InsertCellPoint(pa.GetNumberOfPoints() - 1)
-        
-    polydata = vtk.vtkPolyData()
-    polydata.SetPoints(pa)
-    polydata.GetPointData().AddArray(val)
-    polydata.GetPointData().AddArray(cp_ids)
-    polydata.SetVerts(ca)
+
+def cell_voxels(cell_ids, shape):
+    '''
+    this function maps mscomplex cells to the voxels they own.
+    a cell with cell id c covers the voxels c // 2 and (c + 1) // 2 along
+    every axis; it owns the lower one (c // 2), and the last cube along an
+    axis (c == 2 * n - 3) also owns the voxel after it, so every voxel is
+    owned by exactly one cube.
+    Args:
+        cell_ids (np.array): integer cell ids (n, 3)
+        shape (tuple): shape of the image
+    Returns:
+        np.array: flat voxel indices owned by each cell, (n, 8) with -1 for
+            the corners not owned
+    '''
+    cell_ids = np.asarray(cell_ids, dtype=np.int64).reshape(-1, 3)
+    shape = np.asarray(shape, dtype=np.int64)
+    strides = np.array([shape[1] * shape[2], shape[2], 1], dtype=np.int64)
+    base = (cell_ids >> 1) @ strides
+    last = cell_ids == 2 * shape - 3
+
+    owned = np.full((len(cell_ids), 8), -1, dtype=np.int64)
+    for k, off in enumerate(itertools.product((0, 1), repeat=3)):
+        off = np.array(off, dtype=bool)
+        keep = np.all(last[:, off], axis=1)
+        owned[keep, k] = base[keep] + strides[off].sum()
+    return owned
+
+
+def dual_cell_ids(des_geom, dp, shape):
+    '''
+    this function returns the integer cell ids of dual points from their
+    ids.
+    the dual points are the centres of the cubes of the grid in order,
+    the axis that varies fastest is read off the first two of them.
+    Args:
+        des_geom (np.array): dual point ids
+        dp (np.array): dual points
+        shape (tuple): shape of the image
+    Returns:
+        np.array: cell ids (n, 3)
+    '''
+    order = 'C' if dp[1][2] != dp[0][2] else 'F'
+    ind = np.unravel_index(np.asarray(des_geom, dtype=np.int64).reshape(-1),
+                           tuple(np.subtract(shape, 1)), order=order)
+    return 2 * np.stack(ind, axis=1) + 1
+
+
+def grain_voxels(des_geom, dp, img):
+    '''
+    this function returns the voxels of the grain of a maximum that do
+    not lie in the background.
+    the cell ids of the dual points of des_geom are mapped to voxels
+    with cell_voxels; if none of them survives the 8 voxels around every
+    dual point are used instead.
+    Args:
+        des_geom (np.array): dual point ids of the descending manifold
+        dp (np.array): dual points
+        img (np.array): distance field
+    Returns:
+        np.array: sorted flat voxel indices
+    '''
+    cell_ids = dual_cell_ids(des_geom, dp, img.shape)
+    flat_img = img.reshape(-1)
+
+    owned = cell_voxels(cell_ids, img.shape)
+    points = np.sort(owned[owned >= 0])
+    points = points[flat_img[points] > 0]
+    if len(points) == 0:
+        # every corner of the cells
+        strides = np.array([img.shape[1] * img.shape[2], img.shape[2], 1])
+        corners = np.array(list(itertools.product((0, 1), repeat=3))) @ strides
+        points = np.unique(((cell_ids >> 1) @ strides)[:, np.newaxis] + corners)
+        points = points[flat_img[points] > 0]
+    return points
+
+
+def write_grain_vtp(cp_id, points, vals, ensem_dir):
+    '''
+    this function saves the points of one grain in a vtp file
+    Args:
+        cp_id (int): critical point id
+        points (np.array): dual points of the grain
+        vals (np.array): distance value at each of the points
+        ensem_dir (str): directory to save the vtp file
+    '''
+    polydata = build_polydata(points.astype(np.float32), verts=vert_cells(len(points)),
+                              point_data=[to_vtk_array(vals, 'Distance Val', np.float32),
+                                          to_vtk_array(np.full(len(points), cp_id), "CP ID", np.int32)])
 
     # Write the file
     writer = vtk.vtkXMLPolyDataWriter()
@@ -67,70 +209,259 @@ def save_grain_vtp(cp_id, msc, dp, img, ensem_dir):
     writer.Write()
 
 
-def proc_work(list_cp_ids, msc, dp, img, ensem_dir):
+def des_man_quads_batch(list_2_saddle, store, image):
     '''
-    this function traverses the des_geom of a critical point and
-    saves the points in a vtp file.
-    this function is used for multiprocessing.
+    this function evaluates the descending manifolds of a chunk of
+    2-saddles at once.
+    the quads of all saddles are sliced from the geometry store, the
+    distance values at their four corners are gathered with a single
+    fancy-index and quads with a corner in the background are dropped.
     Args:
-        list_cp_ids (list): list of critical point ids
-        msc (pyms3d.mscomplex): mscomplex object
-        dp (np.array): dual points
-        img (np.array): distance field
-        ensem_dir (str): directory to save the vtp file
+        list_2_saddle (list): list of 2-saddle points
+        store (dict): geometry store of the descending manifolds of the
+            2-saddles, see geom_store
+        image (np.array): distance field
+    Returns:
+        np.array: surviving descending manifold quads (n, 4)
+        np.array: 2-saddle owning each of the quads (n,)
     '''
-    for cp_id in tqdm(list_cp_ids):
-        save_grain_vtp(cp_id, msc, dp, img, ensem_dir)
+    list_2_saddle = np.asarray(list_2_saddle, dtype=np.int64)
+    quads, lens = rows_geom(store, cp_rows(store, list_2_saddle))
+    quads, lens = quads.reshape(-1, 4), lens // 4
+    if len(quads) == 0:
+        return np.empty((0, 4), dtype=np.int64), np.empty(0, dtype=np.int64)
 
+    # corners of every quad as voxel coordinates -- (n, 4, 3)
+    corners = store['points'][quads].astype(int)
+    dist_vals = image[corners[..., 0], corners[..., 1], corners[..., 2]]
+    surv = dist_vals.min(axis=1) > 0
+    owners = np.repeat(list_2_saddle, lens)
+    return quads[surv], owners[surv]
 
-def contact_region_task(pid, save_dir, list_2_saddle, msc, primal_pts, image, isDesManifold):
+
+def contact_region_task(pid, save_dir, sads, msc, store, image,
+                        isDesManifold, chunk_size=4096):
     '''
-    this function extracts the survival saddles, critical point ids and
-    descending manifold quadrants for a given process id.
+    this function keeps the saddles connected to two maxima and extracts
+    their critical point ids and descending manifold quadrants.
     this function is used for multiprocessing.
     Args:
         pid (int): process id
-        save_dir (str): directory to save the data
-        list_2_saddle (list): list of 2-saddle points
-        msc (pyms3d.mscomplex): mscomplex object
-        primal_pts (np.array): primal points
+        save_dir (str): directory to also save the data, None to skip
+        sads (list): 2-saddle points in the foreground
+        msc (msc object): Morse complex object
+        store (dict): geometry store of the descending manifolds of the
+            2-saddles
         image (np.array): distance field
         isDesManifold (bool): flag to extract descending manifold
+        chunk_size (int): number of saddles evaluated in one batch
+    Returns:
+        np.array: surviving 2-saddles
+        np.array: the two maxima connected by each surviving 2-saddle (n, 2)
+        np.array: 2-saddle owning each of the quads
+        np.array: surviving descending manifold quads
     '''
-    surv_sads = np.array([])
-    cp_ids = np.array([])
-    des_man_quads = []
-    for s in tqdm(list_2_saddle):
-        # ignore the saddles in background
-        # or saddle which is connected to just one maxima
-        if (msc.cp_func(s) < 0) or (len(msc.asc(s)) != 2):
-            # print("Saddle belongs to background")
-            continue
+    sads = np.asarray(sads, dtype=np.int64)
+    # maxima connected by each saddle, saddles of a single maximum are dropped
+    maxima = [msc.asc(s)[:, 0] for s in sads]
+    keep = np.array([len(m) == 2 for m in maxima], dtype=bool)
+    surv_sads = sads[keep]
+    maxima = np.array([m for m, k in zip(maxima, keep) if k],
+                      dtype=np.int64).reshape(-1, 2)
+
+    cp_ids = [np.empty(0, dtype=np.int64)]
+    des_man_quads = [np.empty((0, 4), dtype=np.int64)]
+    if isDesManifold:
+        # descending manifold geometry of the 2-saddle points, a chunk at a time
+        for i in tqdm(range(0, len(surv_sads), chunk_size)):
+            quads, owners = des_man_quads_batch(
+                surv_sads[i:i + chunk_size], store, image)
+            des_man_quads.append(quads)
+            cp_ids.append(owners)
+    cp_ids = np.concatenate(cp_ids)
+    des_man_quads = np.concatenate(des_man_quads)
 
-        # if (msc.cp_func(msc.asc(s)[0, 0]) < 0) or (msc.cp_func(msc.asc(s)[1, 0]) < 0):
-        #     print("This maxima point lies in the background.")
-
-        # Descending manifold geometry of 2-saddle point
-        # surv_sads.append(int(s))  # added inplace of exract surv saddle
-        surv_sads = np.append(surv_sads, int(s))
-        if isDesManifold:
-            des_man = msc.des_geom(s)
-            for elem in des_man:
-                # check if elem in descending manifold belongs to background
-                ind = np.ravel_multi_index(
-                    primal_pts[elem].astype(int).transpose(), image.shape)
-                dist_vals = image.ravel()[ind]
-                if (np.min(dist_vals) <= 0):
-                    continue
-
-                # for a  correct elem stores the cp_id and des_man_quad
-                # cp_ids.append(int(s))
-                cp_ids = np.append(cp_ids, int(s))
-                des_man_quads.append(elem)
-                # des_man_quads = np.append(des_man_quads, elem)
-    
-    des_man_quads = np.array(des_man_quads)
     # save the data
-    np.save(save_dir + "/surv_sads_%d.npy" % pid, surv_sads)
-    np.save(save_dir + "/cp_ids_%d.npy" % pid, cp_ids)
-    np.save(save_dir + "/des_man_quads_%d.npy" % pid, des_man_quads)
\ No newline at end of file
+    if save_dir is not None:
+        np.save(save_dir + "/surv_sads_%d.npy" % pid, surv_sads)
+        np.save(save_dir + "/sad_maxima_%d.npy" % pid, maxima)
+        np.save(save_dir + "/cp_ids_%d.npy" % pid, cp_ids)
+        np.save(save_dir + "/des_man_quads_%d.npy" % pid, des_man_quads)
+    return surv_sads, maxima, cp_ids, des_man_quads
+
+
+def init_contact_region_worker(msc, store_src=None, image_spec=None):
+    '''
+    pool initializer for contact_region_worker.
+    keeps the msc inherited by the forked worker, opens the geometry
+    store once per worker, memory-mapped when it is saved, and attaches
+    to the shared distance field.
+    Args:
+        msc (msc object): Morse complex object, inherited by forked workers
+        store_src (str or dict): prefix of the saved geometry store, or
+            the store inherited by forked workers, None without manifolds
+        image_spec (tuple): shared memory spec of the distance field, None
+            without manifolds
+    '''
+    _worker['msc'] = msc
+    _worker['store'] = open_geom_store(store_src)
+    _worker['image'] = None
+    if image_spec is not None:
+        _worker['image_shm'], _worker['image'] = attach_array(image_spec)
+
+
+def contact_region_worker(pid, save_dir, sads, isDesManifold):
+    '''
+    contact_region_task on the state loaded by init_contact_region_worker.
+    a task only carries the saddle ids.
+    Args:
+        pid (int): process id
+        save_dir (str): directory to also save the data, None to skip
+        sads (list): 2-saddle points in the foreground
+        isDesManifold (bool): flag to extract descending manifold
+    Returns:
+        tuple: arrays returned by contact_region_task
+    '''
+    return contact_region_task(pid, save_dir, sads, _worker['msc'],
+                               _worker['store'], _worker['image'], isDesManifold)
+
+
+def init_segmentation_worker(store_src, img_spec, seg_spec=None, locks=None):
+    '''
+    pool initializer for the segmentation workers.
+    opens the geometry store of the descending manifolds of the maxima
+    once per worker, memory-mapped when it is saved, and attaches to the
+    shared distance field.
+    Args:
+        store_src (str or dict): prefix of the saved geometry store, or
+            the store inherited by forked workers
+        img_spec (tuple): shared memory spec of the distance field
+        seg_spec (tuple): shared memory spec of the label volume, for
+            segmentation_np_worker
+        locks (list): one lock per block of the flat label volume
+    '''
+    _worker['store'] = open_geom_store(store_src)
+    _worker['img_shm'], _worker['img'] = attach_array(img_spec)
+    if seg_spec is not None:
+        _worker['seg_shm'], _worker['seg'] = attach_array(seg_spec)
+        _worker['locks'] = locks
+
+
+def segmentation_vtp_worker(list_cp_ids, ensem_dir=None):
+    '''
+    this function collects the dual points of the grains of a list of
+    maxima and packs them into shared memory.
+    Args:
+        list_cp_ids (list): list of critical point ids, in the foreground
+        ensem_dir (str): directory to also save a vtp file per grain, optional
+    Returns:
+        int: number of points
+        tuple: pack_shared spec of the points, CP IDs and distance values
+    '''
+    store, img = _worker['store'], _worker['img']
+    dp = store['points']
+    pts, ids, vals = [np.empty((0, 3), np.float32)], [], []
+    for cp_id, row in zip(list_cp_ids, cp_rows(store, list_cp_ids)):
+        g_pts, g_vals = grain_points(cp_geom(store, row), dp, img)
+        if ensem_dir is not None:
+            write_grain_vtp(cp_id, g_pts, g_vals, ensem_dir)
+        pts.append(g_pts.astype(np.float32))
+        ids.append(np.full(len(g_pts), cp_id, dtype=np.int32))
+        vals.append(g_vals.astype(np.float32))
+    pts = np.concatenate(pts)
+    ids = np.concatenate([np.empty(0, np.int32)] + ids)
+    vals = np.concatenate([np.empty(0, np.float32)] + vals)
+    return len(pts), pack_shared([pts, ids, vals])
+
+
+def segmentation_np_worker(list_ranks, list_cp_ids):
+    '''
+    this function labels the grains of a list of maxima in the shared
+    label volume.
+    the volume holds the rank (position in cps_max + 1) of the labelling
+    maximum and every voxel keeps the highest rank written to it, so the
+    result does not depend on the order the workers run in and equals the
+    serial loop where later maxima overwrite earlier ones.
+    Args:
+        list_ranks (list): rank of each of the maxima
+        list_cp_ids (list): list of critical point ids, in the foreground
+    Returns:
+        dict: ranks, centers and vols of the labelled grains
+    '''
+    store, img = _worker['store'], _worker['img']
+    seg, locks = _worker['seg'].reshape(-1), _worker['locks']
+    dp = store['points']
+    num_slabs = len(locks)
+    slab_size = -(-img.size // num_slabs)
+    out = dict(ranks=[], centers=[], vols=[])
+    for rank, row in zip(list_ranks, cp_rows(store, list_cp_ids)):
+        points_ind = grain_voxels(cp_geom(store, row), dp, img)
+        if len(points_ind) == 0:
+            continue
+
+        # update the voxels slab by slab while holding the slab lock, the
+        # indices are sorted so every slab is a contiguous range
+        slabs = points_ind // slab_size
+        bounds = np.searchsorted(slabs, np.arange(num_slabs + 1))
+        for k in range(num_slabs):
+            if bounds[k] == bounds[k + 1]:
+                continue
+            ind = points_ind[bounds[k]:bounds[k + 1]]
+            with locks[k]:
+                seg[ind] = np.maximum(seg[ind], rank)
+
+        out['ranks'].append(rank)
+        out['centers'].append(np.mean(np.unravel_index(points_ind, img.shape), axis=1))
+        out['vols'].append(len(points_ind))
+    return out
+
+
+def init_threshold_worker(arr_spec, ls_spec, slice_func):
+    '''
+    pool initializer for the slicewise boundary extraction.
+    attaches to the shared image and the shared binary volume.
+    Args:
+        arr_spec (tuple): shared memory spec of the image
+        ls_spec (tuple): shared memory spec of the binary volume
+        slice_func (callable): slice -> (threshold, binary slice, iterations),
+            or slab -> (binary slab, iterations) for contour_slab_worker
+    '''
+    _worker['arr_shm'], _worker['arr'] = attach_array(arr_spec)
+    _worker['ls_shm'], _worker['ls'] = attach_array(ls_spec)
+    _worker['slice_func'] = slice_func
+
+
+def threshold_worker(ii):
+    '''
+    this function thresholds slice ii of the shared image and writes
+    the binary slice into the shared volume.
+    Args:
+        ii (int): slice index
+    Returns:
+        float: threshold of the slice, 0 for an empty slice
+        int: iterations of the active contour
+    '''
+    slice = _worker['arr'][ii]
+    if np.max(slice) == 0:
+        return 0, 0
+    thresh, _worker['ls'][ii], n_iter = _worker['slice_func'](slice)
+    return thresh, n_iter
+
+
+def contour_slab_worker(z0, z1, overlap):
+    '''
+    this function refines slices z0 to z1 of the shared image with the
+    active contour. the slab is extended by overlap slices on both
+    sides so the contour at its ends sees its neighbours, only slices
+    z0 to z1 are written into the shared volume.
+    Args:
+        z0 (int): first slice
+        z1 (int): slice after the last
+        overlap (int): slices added on both sides
+    Returns:
+        int: iterations of the active contour
+    '''
+    lo, hi = max(z0 - overlap, 0), min(z1 + overlap, len(_worker['arr']))
+    ls, n_iter = _worker['slice_func'](_worker['arr'][lo:hi])
+    _worker['ls'][z0:z1] = ls[z0 - lo:z1 - lo]
+    return n_iter
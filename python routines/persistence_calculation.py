@@ -1,25 +1,77 @@
 import pyms3d_core as pyms3d
 import numpy as np
+import os
 import matplotlib.pyplot as plt
 import kneed
 from datetime import datetime
 from scipy.interpolate import UnivariateSpline
+from geom_store import msc_file_key
 
 
-def compute_pers_diagm(data_file_name, dim, mode):
-    """Comput the persistence diagram
+def file_key(file_name):
+    """Key of a file from its path, size and modification time
 
     Args:
-        data_file_name (str): raw file with distance field
-        dim (tuple): dimensions of distance field 
-        mode (str): mode of computation (manual or automatic)
+        file_name (str): file to key
 
     Returns:
-        float: knee point
+        str: absolute path, size and modification time of the file
+    """
+    return '%s-%s' % (os.path.abspath(file_name), msc_file_key(file_name))
+
+
+def load_msc(msc_file):
+    """Load a saved msc
+
+    Args:
+        msc_file (str): file saved by msc.save
+
+    Returns:
+        msc: unsimplified msc
     """
-    # Comput msc
     msc = pyms3d.MsComplex()
-    msc.compute_bin(data_file_name, dim)
+    msc.load(msc_file)
+    return msc
+
+
+def load_pers_cache(cache_file, key):
+    """Load the persistence pairs stored by save_pers_cache
+
+    Args:
+        cache_file (str): .npz cache file
+        key (str): key of the distance field file the cache has to belong to, see file_key
+
+    Returns:
+        dict: birth, death, saddle and maxima arrays, None if there is no valid cache
+    """
+    if not os.path.exists(cache_file):
+        return None
+    with np.load(cache_file) as f:
+        if str(f['key']) != key:
+            return None
+        return {k: f[k] for k in ('birth', 'death', 'saddle', 'maxima')}
+
+
+def save_pers_cache(cache_file, key, pairs):
+    """Store the persistence pairs
+
+    Args:
+        cache_file (str): .npz cache file
+        key (str): key of the distance field file
+        pairs (dict): birth, death, saddle and maxima arrays
+    """
+    np.savez(cache_file, key=key, **pairs)
+
+
+def pers_pairs(msc):
+    """Saddle-maximum persistence pairs of an unsimplified msc
+
+    Args:
+        msc (msc): unsimplified msc, it is fully simplified by this function
+
+    Returns:
+        dict: birth, death, saddle and maxima arrays
+    """
     # simplify for base case
     msc.simplify_pers(thresh=0.0, is_nrm=True)
     # get the critical points
@@ -34,10 +86,50 @@ def compute_pers_diagm(data_file_name, dim, mode):
     # saddle--maximum pairs cancelled in simplification
     cp_pairs = msc.cps_pairid()
 
+    sad = cp_pairs[cps_max]
+    return dict(birth=cps_fun_vals[sad], death=cps_fun_vals[cps_max],
+                saddle=sad, maxima=cps_max)
+
+
+def compute_pers_diagm(data_file_name, dim, mode, msc=None, cache_file=None,
+                       cache_key=None):
+    """Comput the persistence diagram
+
+    Args:
+        data_file_name (str): raw file with distance field
+        dim (tuple): dimensions of distance field 
+        mode (str): mode of computation (manual or automatic)
+        msc (msc or str, optional): unsimplified msc of the distance field, or the file
+            it is saved in. It is fully simplified by this function, a new one is
+            computed if None. Defaults to None.
+        cache_file (str, optional): .npz file caching the persistence pairs. Defaults to None.
+        cache_key (str, optional): key of data_file_name, see file_key, computed if None. Defaults to None.
+
+    Returns:
+        float: knee point
+    """
+    pairs = None
+    if cache_file is not None:
+        if cache_key is None:
+            cache_key = file_key(data_file_name)
+        pairs = load_pers_cache(cache_file, cache_key)
+
+    if pairs is None:
+        # Comput msc
+        if msc is None:
+            msc = pyms3d.MsComplex()
+            msc.compute_bin(data_file_name, dim)
+        elif isinstance(msc, str):
+            msc = load_msc(msc)
+        pairs = pers_pairs(msc)
+        if cache_file is not None:
+            save_pers_cache(cache_file, cache_key, pairs)
+    else:
+        print("Using cached persistence pairs: ", cache_file)
+
     # persistence diagram between birth and death
-    sad = cp_pairs[cps_max, np.newaxis]
-    b_value = cps_fun_vals[sad]
-    d_value = cps_fun_vals[cps_max, np.newaxis]
+    b_value = pairs['birth'][:, np.newaxis]
+    d_value = pairs['death'][:, np.newaxis]
     pers = d_value - b_value
     # p_diagm_list = np.concatenate((b_value, d_value, pers, sad,
     #                               cps_max[:, np.newaxis]), axis=1)
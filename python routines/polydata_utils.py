@@ -0,0 +1,179 @@
+# import modules
+import numpy as np
+import vtk
+import vtk.util.numpy_support as nps
+
+# Build vtk polydata in bulk from numpy arrays instead of inserting
+# points and cells one at a time.
+
+# numpy type matching vtkIdType
+ID_TYPE = nps.get_vtk_to_numpy_typemap()[vtk.VTK_ID_TYPE]
+
+
+def to_vtk_array(arr, name, dtype=None):
+    """Convert a numpy array to a named vtk data array.
+
+    Args:
+        arr (numpy array): values, one row per tuple
+        name (str): name of the vtk array
+        dtype (numpy dtype, optional): cast to this type first. Defaults to None.
+
+    Returns:
+        vtk data array: deep copy of the values
+    """
+    arr = np.ascontiguousarray(arr, dtype=dtype)
+    vtk_arr = nps.numpy_to_vtk(arr, deep=1)
+    vtk_arr.SetName(name)
+    return vtk_arr
+
+
+def cell_array(connectivity, offsets=None, cell_size=None):
+    """Build a vtkCellArray from connectivity and offsets arrays.
+
+    Args:
+        connectivity (numpy array): point ids of all cells, concatenated
+        offsets (numpy array, optional): start of every cell in connectivity
+            followed by len(connectivity). Defaults to None.
+        cell_size (int, optional): number of points of every cell, used when
+            offsets is None. Defaults to None.
+
+    Returns:
+        vtkCellArray: cell array
+    """
+    connectivity = np.ascontiguousarray(connectivity, dtype=ID_TYPE).ravel()
+    if offsets is None:
+        offsets = np.arange(0, len(connectivity) + 1, cell_size,
+                            dtype=ID_TYPE)
+    offsets = np.ascontiguousarray(offsets, dtype=ID_TYPE)
+
+    ca = vtk.vtkCellArray()
+    ca.SetData(nps.numpy_to_vtkIdTypeArray(offsets, deep=1),
+               nps.numpy_to_vtkIdTypeArray(connectivity, deep=1))
+    return ca
+
+
+def vert_cells(num_points):
+    """One vertex cell for every point.
+
+    Args:
+        num_points (int): number of points
+
+    Returns:
+        vtkCellArray: vertex cells
+    """
+    return cell_array(np.arange(num_points), cell_size=1)
+
+
+def build_polydata(points, verts=None, lines=None, polys=None,
+                   point_data=(), cell_data=()):
+    """Build a vtkPolyData from numpy arrays.
+
+    Args:
+        points (numpy array or vtkPoints): point coordinates (n, 3)
+        verts (vtkCellArray, optional): vertex cells. Defaults to None.
+        lines (vtkCellArray, optional): line cells. Defaults to None.
+        polys (vtkCellArray, optional): polygon cells. Defaults to None.
+        point_data (iterable, optional): vtk arrays added to the point data. Defaults to ().
+        cell_data (iterable, optional): vtk arrays added to the cell data. Defaults to ().
+
+    Returns:
+        vtk polydata: polydata
+    """
+    if not isinstance(points, vtk.vtkPoints):
+        pa = vtk.vtkPoints()
+        pa.SetData(nps.numpy_to_vtk(
+            np.ascontiguousarray(points).reshape(-1, 3), deep=1))
+        points = pa
+
+    pd = vtk.vtkPolyData()
+    pd.SetPoints(points)
+    if verts is not None:
+        pd.SetVerts(verts)
+    if lines is not None:
+        pd.SetLines(lines)
+    if polys is not None:
+        pd.SetPolys(polys)
+    for arr in point_data:
+        pd.GetPointData().AddArray(arr)
+    for arr in cell_data:
+        pd.GetCellData().AddArray(arr)
+    return pd
+
+
+def cell_pieces(pd, num_pieces, split='id'):
+    """Piece of every cell of a polydata.
+
+    Args:
+        pd (vtk polydata): polydata to be split
+        num_pieces (int): number of pieces
+        split (str, optional): 'id' -- contiguous ranges of cell ids, 'spatial' --
+            equal slabs along the longest side of the bounding box. Defaults to 'id'.
+
+    Returns:
+        numpy array: piece of every cell, in the vtk cell order
+    """
+    num_cells = pd.GetNumberOfCells()
+    if split == 'id':
+        return (np.arange(num_cells) * num_pieces // max(num_cells, 1)).astype(np.int32)
+    if split != 'spatial':
+        raise ValueError(f"Unknown split: {split}")
+
+    # the first point of every cell decides its slab
+    pts = nps.vtk_to_numpy(pd.GetPoints().GetData())
+    first = np.concatenate([nps.vtk_to_numpy(ca.GetConnectivityArray())[
+        nps.vtk_to_numpy(ca.GetOffsetsArray())[:-1]] for ca in _cell_arrays(pd)])
+    lo, hi = pts.min(axis=0), pts.max(axis=0)
+    axis = int(np.argmax(hi - lo))
+    x = pts[first, axis]
+    width = max(float(hi[axis] - lo[axis]), np.finfo(np.float32).tiny)
+    return np.minimum((x - lo[axis]) / width * num_pieces, num_pieces - 1).astype(np.int32)
+
+
+def _cell_arrays(pd):
+    """Verts, lines and polys of a polydata, in the vtk cell order."""
+    if pd.GetNumberOfStrips():
+        raise ValueError("Triangle strips are not supported")
+    return [pd.GetVerts(), pd.GetLines(), pd.GetPolys()]
+
+
+def extract_piece(pd, cell_mask):
+    """Polydata with a subset of the cells and the points they use.
+
+    Args:
+        pd (vtk polydata): polydata
+        cell_mask (numpy array): cells to keep, in the vtk cell order
+
+    Returns:
+        vtk polydata: cells, points, point data and cell data of the piece
+    """
+    pts = nps.vtk_to_numpy(pd.GetPoints().GetData())
+    used = np.zeros(len(pts), dtype=bool)
+    start, pieces = 0, []
+    for ca in _cell_arrays(pd):
+        conn = nps.vtk_to_numpy(ca.GetConnectivityArray())
+        offsets = nps.vtk_to_numpy(ca.GetOffsetsArray())
+        sizes = np.diff(offsets)
+        keep = cell_mask[start:start + len(sizes)]
+        start += len(sizes)
+        conn = conn[np.repeat(keep, sizes)]
+        used[conn] = True
+        pieces.append((conn, np.concatenate(([0], np.cumsum(sizes[keep])))))
+
+    # renumber the used points
+    point_ids = np.flatnonzero(used)
+    new_ids = np.full(len(pts), -1, dtype=ID_TYPE)
+    new_ids[point_ids] = np.arange(len(point_ids))
+    verts, lines, polys = [cell_array(new_ids[conn], offsets) if len(offsets) > 1
+                           else None for conn, offsets in pieces]
+
+    def subset(data, ids):
+        out = []
+        for i in range(data.GetNumberOfArrays()):
+            arr = data.GetArray(i)
+            if arr is not None:
+                out.append(to_vtk_array(nps.vtk_to_numpy(arr)[ids], arr.GetName()))
+        return out
+
+    return build_polydata(pts[point_ids], verts=verts, lines=lines, polys=polys,
+                          point_data=subset(pd.GetPointData(), point_ids),
+                          cell_data=subset(pd.GetCellData(), np.flatnonzero(cell_mask)))
@@ -0,0 +1,54 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from histogram import HIST_THRESHOLDS, contrast_stretch, image_histogram
+
+# SimpleITK filters the histogram thresholds replace in bd_extraction
+FILTERS = dict(
+    Isodata=sitk.IsoDataThresholdImageFilter,
+    Li=sitk.LiThresholdImageFilter,
+    Otsu=sitk.OtsuThresholdImageFilter,
+    Triangle=sitk.TriangleThresholdImageFilter,
+    Yen=sitk.YenThresholdImageFilter,
+)
+
+
+def grains_volume(seed, dtype=np.uint16):
+    """Noisy two phase volume of grains in a darker background."""
+    rng = np.random.default_rng(seed)
+    z, y, x = np.mgrid[:48, :48, :48]
+    grains = (np.sin(x / rng.uniform(3, 8)) * np.sin(y / 6.) * np.sin(z / 7.)
+              > rng.uniform(-0.5, 0.6))
+    arr = (np.where(grains, rng.uniform(22000, 50000), rng.uniform(1000, 20000))
+           + rng.normal(0, rng.uniform(500, 8000), grains.shape))
+    if dtype == np.uint8:
+        arr /= 257
+    return arr.clip(0, np.iinfo(dtype).max).astype(dtype)
+
+
+def sitk_threshold(name, arr):
+    filt = FILTERS[name]()
+    filt.Execute(sitk.GetImageFromArray(arr))
+    return filt.GetThreshold()
+
+
+@pytest.mark.parametrize('name', sorted(FILTERS))
+@pytest.mark.parametrize('seed', range(6))
+def test_stretched_uint16_thresholds(name, seed):
+    arr = grains_volume(seed)
+    # the 1% / 99% clipping fills the first and the last bin
+    hist = contrast_stretch(arr, 0.01, 0.99)
+    assert hist[0] > 0 and hist[-1] > 0
+    assert HIST_THRESHOLDS[name](hist) == sitk_threshold(name, arr)
+
+
+@pytest.mark.parametrize('name', sorted(FILTERS))
+@pytest.mark.parametrize('dtype', [np.uint8, np.uint16])
+def test_thresholds(name, dtype):
+    arr = grains_volume(7, dtype)
+    assert HIST_THRESHOLDS[name](image_histogram(arr)) == sitk_threshold(name, arr)
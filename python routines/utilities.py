@@ -1,6 +1,4 @@
 # import modules
-import h5py
-import itertools
 import itk
 from matplotlib import pyplot as plt
 from numba import jit
@@ -8,18 +6,62 @@ import numba
 import numpy as np
 import os
 import re
-from scipy import io
 import SimpleITK as sitk
 from skimage import filters
-from skimage.measure import block_reduce
 from skimage.segmentation import morphological_chan_vese
 import vtk
 import vtk.util.numpy_support as nps
 import time
 import multiproc
-from multiprocessing import Pool, cpu_count, Process
+from geom_store import cp_geom, cp_rows, geom_store, rows_geom
+from histogram import HIST_THRESHOLDS, image_histogram
+from label_stats import compact_lut
+from polydata_utils import build_polydata, cell_array, to_vtk_array, vert_cells
+from multiprocessing import Lock, Pool, cpu_count, shared_memory
+from functools import partial
 from tqdm import tqdm
 import shutil
+from volume_reader import read_volume
+
+# processes forked after a parallel numba kernel ran on the tbb threading layer
+# hang on exit, and the pools here fork
+numba.config.THREADING_LAYER = 'workqueue'
+
+
+def active_contour(image, thresh, num_iter=200, tol=0):
+    """Active contour (morphological Chan-Vese) with early stopping
+
+    Args:
+        image (np array): two or three dimensional image
+        thresh (float): threshold, image - thresh is the initial level set
+        num_iter (int, optional): maximum number of iterations. Defaults to 200.
+        tol (float, optional): stop once at most this fraction of the pixels changes
+            in an iteration. Defaults to 0.
+
+    Description:
+        Runs morphological_chan_vese one iteration at a time. The level set is its only
+        state, so the result is the same as a single call with the same number of
+        iterations. With tol=0 the contour stops at a fixed point, where further
+        iterations would not change it.
+
+    Returns:
+        np array: level set (float32)
+        int: number of iterations
+    """
+    lambda_1, lambda_2 = 1, 1
+    level_set = image - thresh
+    max_change = tol * image.size
+    it = 0
+    while it < num_iter:
+        new_level_set = morphological_chan_vese(image, 1, init_level_set=level_set,
+                                                lambda1=abs(lambda_1), lambda2=abs(lambda_2),
+                                                smoothing=0)
+        it += 1
+        change = np.count_nonzero(new_level_set != (level_set > 0))
+        level_set = new_level_set
+        if change <= max_change:
+            break
+    return (level_set > 0).astype(np.float32), it
 
 
 def addConnectivityData(dataset):
@@ -42,36 +84,15 @@ def addConnectivityData(dataset):
 
 
 @jit(nopython=True)
-def adaptive_thresh(image, T=0.15):
-    """Adaptive thresholding
-
-    Args:
-        image (uint16 np array): two-dimensional image
-        T (float, optional): background pixel is less than mean*(1-T).
-        Defaults to 0.15.
-    
-    Description:
-        Binarize the grayscale image with adaptive threshold. For each pixel in the image:
-        1. Calculate the mean intensity of a window around the pixel
-        2. If the pixel intensity is greater than mean intensity: foreground pixel
-        3. Otherwise background pixel
-
-        The windowsize is fixed at size of the image / 8.
-
-    Reference:
-    Bradley, D. and Roth, G., 2007. Adaptive thresholding using the integral
-    image. Journal of graphics tools, 12(2), pp.13-21.
-
-    Returns:
-        out_image: thresholded image
-    """
+def _adaptive_slice(image, T, win_size, out_image):
+    """Bradley-Roth threshold of one slice into out_image, see adaptive_thresh."""
     num_row, num_col = image.shape
-    win_size = max(num_row, num_col) // 8
+    if win_size <= 0:
+        win_size = max(num_row, num_col) // 8
     half_win_size = win_size // 2
 
-    # initialize integral image and output image
+    # initialize integral image
     int_image = image.copy().astype(numba.uint64)
-    out_image = np.zeros((num_row, num_col), dtype=numba.uint8)
 
     # integral image
     for col in range(num_col):
@@ -100,11 +121,154 @@ def adaptive_thresh(image, T=0.15):
                 out_image[row, col] = 0
             else:
                 out_image[row, col] = 255
+
+
+@jit(nopython=True)
+def adaptive_thresh(image, T=0.15, win_size=0):
+    """Adaptive thresholding
+
+    Args:
+        image (uint16 np array): two-dimensional image
+        T (float, optional): background pixel is less than mean*(1-T).
+        Defaults to 0.15.
+        win_size (int, optional): side of the window, 0 for size of the image / 8.
+        Defaults to 0.
+    
+    Description:
+        Binarize the grayscale image with adaptive threshold. For each pixel in the image:
+        1. Calculate the mean intensity of a window around the pixel
+        2. If the pixel intensity is greater than mean intensity: foreground pixel
+        3. Otherwise background pixel
+
+        The windowsize is fixed at size of the image / 8 unless win_size is given.
+
+    Reference:
+    Bradley, D. and Roth, G., 2007. Adaptive thresholding using the integral
+    image. Journal of graphics tools, 12(2), pp.13-21.
+
+    Returns:
+        out_image: thresholded image
+    """
+    num_row, num_col = image.shape
+    out_image = np.zeros((num_row, num_col), dtype=numba.uint8)
+    _adaptive_slice(image, T, win_size, out_image)
+    return out_image
+
+
+@jit(nopython=True, parallel=True)
+def adaptive_thresh_stack(stack, T=0.15, win_size=0):
+    """Adaptive thresholding of every slice of a stack
+
+    Args:
+        stack (uint16 np array): three-dimensional image, slices along the first axis
+        T (float, optional): background pixel is less than mean*(1-T).
+        Defaults to 0.15.
+        win_size (int, optional): side of the window, 0 for size of the slice / 8.
+        Defaults to 0.
+
+    Description:
+        Same result as adaptive_thresh on every slice, the slices are thresholded in
+        parallel by one compiled kernel.
+
+    Returns:
+        out_stack: thresholded slices
+    """
+    out_stack = np.zeros(stack.shape, dtype=numba.uint8)
+    for ii in numba.prange(stack.shape[0]):
+        _adaptive_slice(stack[ii], T, win_size, out_stack[ii])
+    return out_stack
+
+
+@jit(nopython=True, parallel=True)
+def adaptive_thresh_3d(image, T=0.15, win_size=(0, 0, 0)):
+    """Three dimensional adaptive thresholding
+
+    Args:
+        image (uint16 np array): three-dimensional image
+        T (float, optional): background voxel is less than mean*(1-T).
+        Defaults to 0.15.
+        win_size (tuple, optional): side of the window along every axis, 0 for size
+        of the image / 8 along the axis. Defaults to (0, 0, 0).
+
+    Description:
+        Bradley-Roth thresholding with a window box around every voxel, so gradients
+        along all three axes (e.g. beam hardening along z) are followed. The window
+        sums come from a summed volume table (uint64, 8 bytes per voxel) built with
+        one parallel prefix sum per axis. The window is clipped at the boundary and
+        the mean is taken over the voxels inside it.
+
+    Reference:
+    Bradley, D. and Roth, G., 2007. Adaptive thresholding using the integral
+    image. Journal of graphics tools, 12(2), pp.13-21.
+
+    Returns:
+        out_image: thresholded image, 0 or 255
+    """
+    nx, ny, nz = image.shape
+    hx = (win_size[0] if win_size[0] > 0 else nx // 8) // 2
+    hy = (win_size[1] if win_size[1] > 0 else ny // 8) // 2
+    hz = (win_size[2] if win_size[2] > 0 else nz // 8) // 2
+
+    # summed volume table, padded with a zero plane in front along every axis
+    table = np.zeros((nx + 1, ny + 1, nz + 1), dtype=numba.uint64)
+    for i in numba.prange(nx):
+        for j in range(ny):
+            temp = numba.uint64(0)
+            for k in range(nz):
+                temp += image[i, j, k]
+                table[i + 1, j + 1, k + 1] = temp
+    for i in numba.prange(nx):
+        for j in range(1, ny):
+            for k in range(1, nz + 1):
+                table[i + 1, j + 1, k] += table[i + 1, j, k]
+    for j in numba.prange(1, ny + 1):
+        for i in range(1, nx):
+            for k in range(1, nz + 1):
+                table[i + 1, j, k] += table[i, j, k]
+
+    out_image = np.zeros((nx, ny, nz), dtype=numba.uint8)
+    for i in numba.prange(nx):
+        i0, i1 = max(i - hx, 0), min(i + hx, nx - 1) + 1
+        for j in range(ny):
+            j0, j1 = max(j - hy, 0), min(j + hy, ny - 1) + 1
+            for k in range(nz):
+                k0, k1 = max(k - hz, 0), min(k + hz, nz - 1) + 1
+
+                region_size = (i1 - i0) * (j1 - j0) * (k1 - k0)
+
+                sum_ = (table[i1, j1, k1] - table[i0, j1, k1] - table[i1, j0, k1]
+                        - table[i1, j1, k0] + table[i0, j0, k1] + table[i0, j1, k0]
+                        + table[i1, j0, k0] - table[i0, j0, k0])
+
+                if image[i, j, k] * region_size > sum_ * (1.0 - T):
+                    out_image[i, j, k] = 255
     return out_image
 
 
+# dictionary of filters
+# Minimum filter is from itk
+# Adaptive filter is manually implemented
+THRESHOLD_FILTERS = dict(
+    Huang=sitk.HuangThresholdImageFilter,
+    Isodata=sitk.IsoDataThresholdImageFilter,
+    InterMode=sitk.IntermodesThresholdImageFilter,
+    Kitt=sitk.KittlerIllingworthThresholdImageFilter,
+    Li=sitk.LiThresholdImageFilter,
+    MaxEnt=sitk.MaximumEntropyThresholdImageFilter,
+    Min=itk.IntermodesThresholdImageFilter,
+    Moments=sitk.MomentsThresholdImageFilter,
+    Otsu=sitk.OtsuThresholdImageFilter,
+    Renyi=sitk.RenyiEntropyThresholdImageFilter,
+    Shanbhag=sitk.ShanbhagThresholdImageFilter,
+    Triangle=sitk.TriangleThresholdImageFilter,
+    Yen=sitk.YenThresholdImageFilter,
+    Adaptive=adaptive_thresh,
+)
+
+
 def bd_extraction(arr, slicewise=True, filterName='InterMode', ace=False,
-                  visualize=False):
+                  visualize=False, parallel=True, win_size=0, ace_iter=200, ace_tol=0,
+                  ace_slabs=False, slab_size=64, overlap=8, hist=None):
     """Boundary extraction from image using different filters
 
     Args:
@@ -113,6 +277,19 @@ def bd_extraction(arr, slicewise=True, filterName='InterMode', ace=False,
         filterName (str, optional): many thresholding filters are available. Defaults to 'InterMode'.
         ace (bool, optional): active countour as boundary surface if true. Defaults to False.
         visualize (bool, optional): visualize the result if true. Defaults to False.
+        parallel (bool, optional): threshold the slices in a process pool. Defaults to True.
+        win_size (int or tuple, optional): window side of the Adaptive filter, per axis
+            in 3d, 0 for size of the image / 8. Defaults to 0.
+        ace_iter (int, optional): maximum iterations of the active contour. Defaults to 200.
+        ace_tol (float, optional): stop the active contour once at most this fraction of
+            the voxels changes in an iteration. Defaults to 0.
+        ace_slabs (bool, optional): refine the 3d active contour in slabs in a process
+            pool when parallel. Defaults to False.
+        slab_size (int, optional): slices per slab of the 3d active contour in slabs.
+            Defaults to 64.
+        overlap (int, optional): slices added on both sides of a slab. Defaults to 8.
+        hist (np array, optional): histogram of arr (see histogram.image_histogram).
+            Defaults to None.
     
     Description:
         Boundary extraction from a gray scale volume image. Different filters can be used:
@@ -131,87 +308,91 @@ def bd_extraction(arr, slicewise=True, filterName='InterMode', ace=False,
         13. Yen - Yen
         14. Adaptive - Adaptive
 
-        Adaptive filter can only be used slice wise.
-        
+        Adaptive filter thresholds the slices with adaptive_thresh_stack, or the whole
+        volume with adaptive_thresh_3d when not slicewise.
+
+        In the parallel slicewise mode the image and the binary volume are placed in
+        shared memory and the workers threshold one slice at a time (see
+        threshold_slice), so the thresholds and the volume are the same as in the
+        serial mode. Visualization always runs serially.
+
+        The active contour stops early (see active_contour), the iterations of every
+        slice are saved in ACE_iterations.txt. In 3d the contour evolves over the whole
+        volume unless ace_slabs is set: the parallel mode then refines overlapping
+        slabs along the first axis and keeps the centre of every slab; the region
+        means of Chan-Vese are per slab instead of global, so the boundary can differ
+        from the whole volume contour.
+
+        The global Isodata, Li, Otsu, Triangle and Yen thresholds of uint8 and uint16
+        images are computed from the histogram of the image, counted once here unless
+        it is given. It is rebinned as the SimpleITK filters bin the image, so the
+        thresholds are those of the filters (see histogram.py).
 
     Returns:
         numpy array: Binary volume after filtering and active contour
     """
     print('Commencing Boundary Extraction')
-    # dictionary of filters
-    # Minimum filter is from itk
-    # Adaptive filter is manually implemented
-    filterTypeList = dict(
-        Huang=sitk.HuangThresholdImageFilter,
-        Isodata=sitk.IsoDataThresholdImageFilter,
-        InterMode=sitk.IntermodesThresholdImageFilter,
-        Kitt=sitk.KittlerIllingworthThresholdImageFilter,
-        Li=sitk.LiThresholdImageFilter,
-        MaxEnt=sitk.MaximumEntropyThresholdImageFilter,
-        Min=itk.IntermodesThresholdImageFilter,
-        Moments=sitk.MomentsThresholdImageFilter,
-        Otsu=sitk.OtsuThresholdImageFilter,
-        Renyi=sitk.RenyiEntropyThresholdImageFilter,
-        Shanbhag=sitk.ShanbhagThresholdImageFilter,
-        Triangle=sitk.TriangleThresholdImageFilter,
-        Yen=sitk.YenThresholdImageFilter,
-        Adaptive=adaptive_thresh,
-    )
-    filterType = filterTypeList[filterName]
+    filterType = THRESHOLD_FILTERS[filterName]
 
     # slicewise thresholding
-    if slicewise:
+    if slicewise and filterName == 'Adaptive' and not ace and not visualize:
+        # one compiled kernel thresholds all the slices in parallel
+        ls = (adaptive_thresh_stack(arr, T=0.10, win_size=win_size) > 100).astype(np.float32)
+        Thresh = np.where(arr.max(axis=(1, 2)) > 0, 100.0, 0.0)
+
+    elif slicewise and parallel and not visualize:
+        num_proc = cpu_count()
+        print("Number of processors: ", num_proc)
+
+        arr_shm, arr_spec = multiproc.share_array(arr)
+        ls_shm, ls_spec = multiproc.share_array(
+            np.zeros(arr.shape, dtype=np.float32))
+        slice_func = partial(threshold_slice, filterName=filterName, ace=ace,
+                             win_size=win_size, ace_iter=ace_iter, ace_tol=ace_tol)
+        try:
+            with Pool(num_proc, initializer=multiproc.init_threshold_worker,
+                      initargs=(arr_spec, ls_spec, slice_func)) as pool:
+                Thresh, Iters = np.array(pool.map(
+                    multiproc.threshold_worker, range(arr.shape[0]),
+                    chunksize=max(1, arr.shape[0] // (8 * num_proc))), dtype=float).reshape(-1, 2).T
+            ls = np.ndarray(arr.shape, dtype=np.float32, buffer=ls_shm.buf).copy()
+        finally:
+            for shm in (arr_shm, ls_shm):
+                shm.close()
+                shm.unlink()
+
+    elif slicewise:
         ls = np.zeros_like(arr, dtype=np.float32)
-        Thresh = np.zeros(arr.shape[0])
+        Thresh, Iters = np.zeros(arr.shape[0]), np.zeros(arr.shape[0])
         for ii, slice in enumerate(arr):
 
             if np.max(slice) == 0:
                 continue
 
-            # thresholding
-            if filterName == 'Min':
-                # minimum filter
-                filter = filterType.New(itk.GetImageFromArray(slice))
-                filter.SetInput(itk.GetImageFromArray(slice))
-                filter.UseInterModeOff()
-                filter.Update()
-                thresh = filter.GetThreshold()
-
-            elif filterName == 'Adaptive':
-                # adaptive thresholding
-                slice = filterType(slice, T=0.10)
-                thresh = 100
-
-            else:
-                # sitk filter
-                filter = filterType()
-                filter.Execute(sitk.GetImageFromArray(slice))
-                thresh = filter.GetThreshold()
-
-            Thresh[ii] = thresh
-
-            # active contour
-            if ace:
-                # active contour
-                lambda_1, lambda_2 = 1, 1
-                active_contour = morphological_chan_vese(slice, 200, init_level_set=(slice-thresh),
-                                                         lambda1=abs(lambda_1), lambda2=abs(lambda_2), smoothing=0)
-                ls[ii, :, :] = (active_contour).astype(np.float32)
-            else:
-                ls[ii, :, :] = (slice > thresh).astype(np.float32)
+            # thresholding and active contour
+            Thresh[ii], ls[ii, :, :], Iters[ii] = threshold_slice(
+                slice, filterName, ace, win_size, ace_iter, ace_tol)
 
             if visualize:
+                # adaptive thresholding returns the binary slice
+                if filterName == 'Adaptive':
+                    slice = filterType(slice, T=0.10, win_size=win_size)
                 fig, (ax0, ax1) = plt.subplots(1, 2, figsize=(18, 9))
                 ax0.imshow(arr[ii, :, :], cmap="Greys")
-                ax1.imshow(slice > thresh, cmap="Greys")
+                ax1.imshow(slice > Thresh[ii], cmap="Greys")
                 plt.savefig(f'./Dump/slice_{ii}.png', dpi=600)
                 plt.close(fig)
 
+    if slicewise:
         # fill enclosed voids in the binary volume
         fill = sitk.BinaryFillholeImageFilter()
         ls = fill.Execute(sitk.GetImageFromArray(ls.astype(np.ubyte)))
         ls = sitk.GetArrayFromImage(ls)
         np.savetxt('Threshold.txt', Thresh, fmt='%10.4f')
+        if ace:
+            np.savetxt('ACE_iterations.txt', Iters, fmt='%d')
+            print('Active contour iterations per slice: min %d, mean %.1f, max %d'
+                  % (Iters.min(), Iters.mean(), Iters.max()))
 
     else:
         # thresholding
@@ -223,9 +404,17 @@ def bd_extraction(arr, slicewise=True, filterName='InterMode', ace=False,
             filter.Update()
             thresh = filter.GetThreshold()
 
+        elif filterName in HIST_THRESHOLDS and arr.dtype in (np.uint8, np.uint16):
+            if hist is None:
+                hist = image_histogram(arr)
+            thresh = HIST_THRESHOLDS[filterName](hist)
+            print("The threshold is: ", thresh)
+
         elif filterName == 'Adaptive':
-            print('Adaptive thresholding is not available for 3d')
-            raise NotImplementedError
+            # adaptive thresholding, the binary volume is thresholded again below
+            win_size = tuple(int(w) for w in np.broadcast_to(win_size, 3))
+            arr = adaptive_thresh_3d(arr, T=0.10, win_size=win_size)
+            thresh = 100
 
         else:
             filter = filterType()
@@ -234,14 +423,30 @@ def bd_extraction(arr, slicewise=True, filterName='InterMode', ace=False,
             print("The threshold is: ", thresh)
 
         # active contour
-        if ace:
-            # active contour
-            lambda_1, lambda_2 = 1, 1
-            active_contour = (morphological_chan_vese(arr, 200,
-                                                      init_level_set=(
-                                                          arr-thresh),
-                                                      lambda1=abs(lambda_1), lambda2=abs(lambda_2), smoothing=0))
-            ls = (active_contour).astype(np.float32)
+        if ace and ace_slabs and parallel and arr.shape[0] > slab_size:
+            num_proc = cpu_count()
+            print("Number of processors: ", num_proc)
+
+            arr_shm, arr_spec = multiproc.share_array(arr)
+            ls_shm, ls_spec = multiproc.share_array(
+                np.zeros(arr.shape, dtype=np.float32))
+            slab_func = partial(active_contour, thresh=thresh, num_iter=ace_iter, tol=ace_tol)
+            slabs = [(z, min(z + slab_size, arr.shape[0]), overlap)
+                     for z in range(0, arr.shape[0], slab_size)]
+            try:
+                with Pool(num_proc, initializer=multiproc.init_threshold_worker,
+                          initargs=(arr_spec, ls_spec, slab_func)) as pool:
+                    Iters = pool.starmap(multiproc.contour_slab_worker, slabs)
+                ls = np.ndarray(arr.shape, dtype=np.float32, buffer=ls_shm.buf).copy()
+            finally:
+                for shm in (arr_shm, ls_shm):
+                    shm.close()
+                    shm.unlink()
+            print('Active contour iterations per slab: ', Iters)
+
+        elif ace:
+            ls, it = active_contour(arr, thresh, ace_iter, ace_tol)
+            print('Active contour iterations: ', it)
         else:
             ls = (arr > thresh).astype(np.float32)
 
@@ -249,11 +454,12 @@ def bd_extraction(arr, slicewise=True, filterName='InterMode', ace=False,
     return ls
 
 
-def bimode_log_min(vols):
+def bimode_log_min(vols, visualize=True):
     """Automatic thresholding -- volume cuoff
 
     Args:
         vols (list): list of volume of particles
+        visualize (bool, optional): show the histogram of log volumes. Defaults to True.
     
     Description:
         For removing low volume noises in segmentation. 
@@ -263,9 +469,10 @@ def bimode_log_min(vols):
     Returns:
         float: volume cutoff
     """
-    plt.figure()
-    plt.hist(np.log(vols))
-    plt.show()
+    if visualize:
+        plt.figure()
+        plt.hist(np.log(vols))
+        plt.show()
     return np.exp(filters.threshold_otsu(np.log(vols)))
 
 
@@ -312,114 +519,161 @@ def check_segmentation(raw_file_name, centers):
     return None
 
 
-def collect_neighbours(points):
-    """This function collects the 8-neighbours for midpoints in a grid
+def clean_segmentation(seg, labs, maximas, keep=None, vol_cutoff=None,
+                       compact=False):
+    """Remove the small labels of a segmentation
 
     Args:
-        points (np array): array of midpoints in a grid
-    
+        seg (np array): label volume (uint32), relabelled in place
+        labs (np array): labels of the segmentation
+        maximas (np array): position of the maximum of each label
+        keep (np array, optional): labels that are never removed, e.g. the maxima
+            of the contact network. Defaults to None.
+        vol_cutoff (float, optional): labels with fewer voxels are removed. Defaults to
+            None, the cutoff is then chosen with bimode_log_min.
+        compact (bool, optional): renumber the remaining labels to 1..n. Defaults to False.
+
     Description:
+        Volumes and centers are counted from the label volume with bincount in one pass
+        over the compacted labels, and all the removed labels are set to 0 with a lookup
+        table gather over the present labels, slab by slab.
 
     Returns:
-        np array: 8-neighbour grid points
+        np array: label volume
+        np array: centers of the remaining labels
+        np array: maximas of the remaining labels
+        np array: labels (the new ones when compact)
+        np array: volumes of the remaining labels
+        np array: the original labels of the remaining labels
     """
-    inc = np.array(list(itertools.product((-0.5, 0.5), repeat=3)))
-    pts = inc.reshape(1, inc.shape[1], inc.shape[0])\
-        + points.reshape(points.shape[0], points.shape[1], 1)
-    pts = pts.transpose([0, 2, 1]).reshape(-1, 3)
-    return np.unique(pts.astype(int), axis=0)
-
-
-def compute_contact_regions(msc, image, isDesManifold=True):
+    labs = np.asarray(labs, dtype=np.int64)
+    maximas = np.asarray(maximas).reshape(len(labs), -1)
+    present, lut, counts, centers = label_counts_centers(seg)
+    # index of every label among the present ones, labels without voxels have none
+    idx = np.minimum(np.searchsorted(present, labs), len(present) - 1)
+    found = present[idx] == labs
+    vols = np.where(found, counts[idx], 0)
+    centers = np.where(found[:, np.newaxis], centers[idx], np.nan)
+
+    if vol_cutoff is None:
+        vol_cutoff = bimode_log_min(vols[vols > 0], visualize=False)
+    print(f'Volume cutoff is: {vol_cutoff}')
+    # label 0 cannot be told apart from the background
+    remove = (vols < vol_cutoff) & (labs != 0)
+    if keep is not None:
+        remove &= ~np.isin(labs, np.asarray(keep))
+    print(f'Number of deleted labels: {np.count_nonzero(remove)}')
+
+    new_lut = present.astype(seg.dtype)
+    new_lut[idx[remove & found]] = 0
+    orig_labs = labs[~remove]
+    new_labs = orig_labs
+    if compact:
+        new_labs = np.cumsum(orig_labs != 0) * (orig_labs != 0)
+        new_lut[idx[~remove & found]] = new_labs[found[~remove]]
+    for x0 in range(0, seg.shape[0], 64):
+        slab = seg[x0:x0 + 64]
+        slab[...] = new_lut[lut[slab]]
+
+    print(f'Number of labels: {len(orig_labs)}')
+    return seg, centers[~remove], maximas[~remove], new_labs, vols[~remove], orig_labs
+
+
+def compute_contact_regions(msc, image, isDesManifold=True, msc_file=None,
+                            pers_thresh=None, scratch_dir=None):
     """Get the contact regions
 
     Args:
         msc (msc object): Morse Complex object
         image (np aray): distance field
-    
+        isDesManifold (bool, optional): build the contact region polydata. Defaults to True.
+        msc_file (str, optional): file saved by initial_msc. Defaults to None.
+        pers_thresh (float, optional): threshold msc was simplified with. Defaults to None.
+        scratch_dir (str, optional): also save the per worker results here, for debugging.
+            Defaults to None.
+
     Description:
+        The saddles in the background are removed first, the workers drop the ones
+        connected to a single maximum with the msc they inherit when the pool forks.
+        The descending manifolds of the 2-saddles come from the geometry store
+        (see geom_store) saved next to msc_file, which the workers memory-map; the
+        distance field is placed in shared memory once, so a task only carries saddle
+        ids. Without msc_file the forked workers inherit an in-memory store.
+        The workers return their saddle ids, maxima and quads as numpy arrays, nothing
+        is written to disk unless scratch_dir is given.
 
     Returns:
-        vtk polydata: vtkpolydata with contact points and cells
+        vtk polydata: vtkpolydata with contact points and cells, None without
+            isDesManifold
+        np array: surviving saddles
+        np array: the two maxima connected by each surviving saddle (n, 2)
     """
-    # get the contact region -- descending manifold of 2-saddle
-    msc.collect_geom(dim=2, dir=0)
-    # ''' critical points type
-    # dim: Critical point type \n"\
-    #     "   dim=-1      --> All (default)\n"\
-    #     "   dim=0,1,2,3 --> Minima, 1-saddle,2-saddle,Maxima \n"\
-    # dir: Geometry type \n"\
-    #     "   dir=0 --> Descending \n"\
-    #     "   dir=1 --> Ascending \n"\
-    #     "   dir=2 --> Both (default) \n"\
-    # '''
-
-    # get the coordinates of primal points
-    primal_pts = msc.primal_points()
-    print("got primal points")
-
     # get the 2 saddle points
-    cps_2sad = msc.cps(2)
+    cps_2sad = np.asarray(msc.cps(2), dtype=np.int64)
     print("got 2-saddles")
 
-    # initialize vtk data type
-    cp_ids = vtk.vtkIntArray()
-    cp_ids.SetName('CP ID')
-    val = vtk.vtkFloatArray()
-    val.SetName('Val')
-    des_man_pts = vtk.vtkPoints()
-    des_man_pts.SetData(nps.numpy_to_vtk(primal_pts, "Pts"))
-    des_man_quads = vtk.vtkCellArray()
-
     num_proc = cpu_count()
     print("Number of processors: ", num_proc)
 
-    proc_works = [[] for i in range(num_proc)]
-    for i, m in enumerate(cps_2sad):
-        proc_works[i % num_proc].append(m)
-        
-    # create a folder for saddle
-    saddle2_folder = '../Outputs/Saddle2'
-
-    if os.path.exists(saddle2_folder):
-        shutil.rmtree(saddle2_folder)
+    # ignore the saddles in background, the workers drop the saddles
+    # connected to just one maxima
+    fg_sads = cps_2sad[msc.cps_func()[cps_2sad] >= 0]
+    proc_works = [fg_sads[i::num_proc] for i in range(num_proc)]
 
-    os.makedirs(saddle2_folder)
+    store, prefix, image_shm, image_spec = None, None, None, None
+    if isDesManifold:
+        # get the contact region -- descending manifold of 2-saddle
+        # ''' critical points type
+        # dim: Critical point type \n"\
+        #     "   dim=-1      --> All (default)\n"\
+        #     "   dim=0,1,2,3 --> Minima, 1-saddle,2-saddle,Maxima \n"\
+        # dir: Geometry type \n"\
+        #     "   dir=0 --> Descending \n"\
+        #     "   dir=1 --> Ascending \n"\
+        #     "   dir=2 --> Both (default) \n"\
+        # '''
+        store, prefix = geom_store(msc, 2, 0, "primal", msc_file, pers_thresh)
+        image_shm, image_spec = multiproc.share_array(image)
+
+    # optional folder for the per worker results
+    if scratch_dir is not None:
+        if os.path.exists(scratch_dir):
+            shutil.rmtree(scratch_dir)
+        os.makedirs(scratch_dir)
+
+    args = [(i, scratch_dir, proc_works[i], isDesManifold)
+            for i in range(num_proc)]
+    try:
+        # the msc cannot be pickled, the forked workers inherit it
+        with Pool(num_proc, initializer=multiproc.init_contact_region_worker,
+                  initargs=(msc, store if prefix is None else prefix,
+                            image_spec)) as pool:
+            results = pool.starmap(multiproc.contact_region_worker, args)
+    finally:
+        if image_shm is not None:
+            image_shm.close()
+            image_shm.unlink()
+
+    # collect the results of all the workers
+    surv_sads = np.concatenate([r[0] for r in results])
+    sad_maxima = np.concatenate([r[1] for r in results])
+    cp_ids = np.concatenate([r[2] for r in results])
+    des_man_quads = np.concatenate([r[3] for r in results])
 
-    args = []
-    for i in range(num_proc):
-        args.append((i, saddle2_folder, proc_works[i], msc, primal_pts, image, isDesManifold))
-    
-    pool = Pool(num_proc)
-    pool.starmap(multiproc.contact_region_task, args)
-
-    surv_sads = []
-
-    # iterate over all the files and collect the results:
-    for i in range(num_proc):
-        p_surv_sads = np.load(saddle2_folder + "/surv_sads_%d.npy" % i)
-        p_des_man_quads = np.load(saddle2_folder + "/des_man_quads_%d.npy" % i)
-        p_cp_ids = np.load(saddle2_folder + "/cp_ids_%d.npy" % i)
-        surv_sads.extend(p_surv_sads)
-        for cid, quad in zip(p_cp_ids, p_des_man_quads):
-            cp_ids.InsertNextValue(int(cid))
-            des_man_quads.InsertNextCell(4)
-            des_man_quads.InsertCellPoint(quad[0])
-            des_man_quads.InsertCellPoint(quad[1])
-            des_man_quads.InsertCellPoint(quad[3])
-            des_man_quads.InsertCellPoint(quad[2])
-    
     # stores the descending manifolds
     des_man = None
     if isDesManifold:
-        des_man = vtk.vtkPolyData()
-        des_man.SetPoints(des_man_pts)
-        des_man.SetPolys(des_man_quads)
-        des_man.GetCellData().AddArray(cp_ids)
-        # des_man.GetPointData().AddArray(val)
+        # get the coordinates of primal points
+        des_man_pts = vtk.vtkPoints()
+        des_man_pts.SetData(nps.numpy_to_vtk(np.asarray(store['points']), "Pts"))
+        # quad corners are stored in z-order, reorder them along the boundary
+        des_man = build_polydata(
+            des_man_pts,
+            polys=cell_array(des_man_quads[:, [0, 1, 3, 2]], cell_size=4),
+            cell_data=[to_vtk_array(cp_ids, 'CP ID', np.int32)])
         des_man = addConnectivityData(des_man)
         # des_man, surv_sads = extract_surviving_sads(des_man, msc)
-    return des_man, surv_sads
+    return des_man, surv_sads, sad_maxima
 
 
 def dist_field_comp(ls):
@@ -517,18 +771,44 @@ def get_dims(filename):
     return dims
 
 
-def get_extremum_graph(msc, surviving_sads):
+def get_extremum_graph(msc, surviving_sads, simplified=False, msc_file=None,
+                       pers_thresh=None, sad_maxima=None):
     """Get the extremum graph of surviving saddles
 
     Args:
         msc (msc object): Morse Smale object
         surviving_sads (list): list of surviving saddle indices
+        simplified (bool, optional): one maximum-saddle-maximum polyline per saddle
+            instead of the ascending manifolds. Defaults to False.
+        msc_file (str, optional): file saved by initial_msc, the geometry store is
+            kept next to it. Defaults to None.
+        pers_thresh (float, optional): threshold msc was simplified with. Defaults to None.
+        sad_maxima (np array, optional): the two maxima of every saddle for the simplified
+            network, see saddle_table. Defaults to None.
     
     Description:
+        The ascending geometries of all saddles are sliced from the geometry store
+        and concatenated, the per cell
+        SaddleIndex / SaddleVal arrays are expanded with np.repeat over the
+        per saddle lengths. The simplified network only needs the saddle table
+        and is meant for fast rendering of large packings.
 
     Returns:
         vtk polydata: vtk polydata with connectivity network
     """
+    sads = np.asarray(surviving_sads, dtype=np.int64).ravel()
+    if simplified:
+        table = saddle_table(msc, sads, sad_maxima)
+        # max1 - saddle - max2 polyline of every saddle, maxima are shared
+        triples = np.stack((table["max1"], sads, table["max2"]), axis=1)
+        cp_ids, conn = np.unique(triples, return_inverse=True)
+        pts = msc.cps_cellid()[cp_ids].astype(np.float32).reshape(-1, 3)/2
+        return build_polydata(
+            pts, lines=cell_array(conn, cell_size=3),
+            point_data=[to_vtk_array(cp_ids, "CP ID", np.int32)],
+            cell_data=[to_vtk_array(sads, "SaddleIndex", np.int32),
+                       to_vtk_array(table["value"], "SaddleVal", np.float32)])
+
     '''
     Collect the geometry of all survivng critical points
         Parameters:
@@ -541,31 +821,18 @@ def get_extremum_graph(msc, surviving_sads):
             dim=0,1,2,3 --> Minima, 1-saddle,2-saddle,Maxima \n"\
     '''
     # Ascending manifold of 2-saddle
-    msc.collect_geom(dim=2, dir=1)
+    store, _ = geom_store(msc, 2, 1, "dual", msc_file, pers_thresh)
     # coordinates of critical points
-    dp = msc.dual_points()
+    dp = np.asarray(store['points'])
 
-    pa, ia = vtk.vtkPoints(), vtk.vtkIntArray()
-    fa, ca = vtk.vtkFloatArray(), vtk.vtkCellArray()
+    pa = vtk.vtkPoints()
     pa.SetData(nps.numpy_to_vtk(dp, "Pts"))
-    ia.SetName("SaddleIndex")
-    fa.SetName("SaddleVal")
-    for s in surviving_sads:
-        s = int(s)
-        # collect the ascending geom
-        gm = msc.asc_geom(s)
-        for a, b in gm:
-            ca.InsertNextCell(2)
-            ca.InsertCellPoint(a)
-            ca.InsertCellPoint(b)
-            ia.InsertNextValue(s)
-            fa.InsertNextValue(msc.cp_func(s))
-    pd = vtk.vtkPolyData()
-    pd.SetPoints(pa)
-    pd.SetLines(ca)
-    pd.GetCellData().AddArray(ia)
-    pd.GetCellData().AddArray(fa)
-    return pd
+    # collect the ascending geom
+    segs, lens = rows_geom(store, cp_rows(store, sads))
+    segs, lens = segs.reshape(-1, 2), lens // 2
+    return build_polydata(pa, lines=cell_array(segs, cell_size=2), cell_data=[
+        to_vtk_array(np.repeat(sads, lens), "SaddleIndex", np.int32),
+        to_vtk_array(np.repeat(msc.cps_func()[sads], lens), "SaddleVal", np.float32)])
 
 
 def get_cp(msc, cp_type):
@@ -584,123 +851,85 @@ def get_cp(msc, cp_type):
     Returns:
         vtk polydata: coordinates, index type, function value, index
     """
-    req_cps = msc.cps(cp_type)
-    cpList = []
+    req_cps = np.asarray(msc.cps(cp_type), dtype=np.int64)
     print(len(req_cps))
-    for m in req_cps:
-        if(msc.cp_func(m) > 0):
-            cpList.append((msc.cp_cellid(m), cp_type, msc.cp_func(m), m))
-    cpList = list(set(cpList))
-    print("done creating cpList of size", len(cpList))
-
-    # TODO: determine why this differs from the above, and whether it is better
-    # cell_ids = msc.cps_cellid()[req_cps]
-    # funcs = msc.cps_func()[req_cps]
-    # cpList2 = [(tuple(id), cp_type, fn, i) for i, (id, fn) in enumerate(zip(cell_ids, funcs)) if fn > 0]
-    # cpList2 = list(set(cpList2))
+    # bulk cell ids and function values, only foreground critical points
+    cell_ids = msc.cps_cellid()[req_cps]
+    funcs = msc.cps_func()[req_cps]
+    fg = funcs > 0
+    # one critical point per cell, ordered by cell id
+    _, first = np.unique(cell_ids[fg], axis=0, return_index=True)
+    req_cps, cell_ids, funcs = req_cps[fg][first], cell_ids[fg][first], funcs[fg][first]
+    print("done creating cpList of size", len(req_cps))
 
     # create the vtk objects
-    pa, ia = vtk.vtkPoints(), vtk.vtkIntArray()
-    fa, cp_ids = vtk.vtkFloatArray(), vtk.vtkIntArray()
-    ia.SetName("Index")
-    fa.SetName("Val")
-    cp_ids.SetName("CP ID")
-
-    ca = vtk.vtkCellArray()
-    for i, (p, idx, val, cpidx) in enumerate(cpList):
-        pa.InsertNextPoint(np.array(p, np.float32)/2)
-        ia.InsertNextValue(idx)
-        fa.InsertNextValue(val)
-        cp_ids.InsertNextValue(cpidx)
-        ca.InsertNextCell(1)
-        ca.InsertCellPoint(i)
+    pts = cell_ids.astype(np.float32).reshape(-1, 3)/2
 
     # Set the outputs
-    pd = vtk.vtkPolyData()
-    pd.SetPoints(pa)
-    pd.SetVerts(ca)
-    pd.GetPointData().AddArray(ia)
-    pd.GetPointData().AddArray(fa)
-    pd.GetPointData().AddArray(cp_ids)
-    return pd
+    return build_polydata(pts, verts=vert_cells(len(req_cps)), point_data=[
+        to_vtk_array(np.full(len(req_cps), cp_type), "Index", np.int32),
+        to_vtk_array(funcs, "Val", np.float32),
+        to_vtk_array(req_cps, "CP ID", np.int32)])
 
 
-def get_saddles(msc, surv_sads):
+def get_saddles(msc, surv_sads, table_file=None, sad_maxima=None):
     """From indices of surviving saddles get further information
 
     Args:
         msc (msc object): Morse complex object
         surv_sads (list): indices of saddle points that survived
+        table_file (str, optional): also save the saddle table as .npz. Defaults to None.
+        sad_maxima (np array, optional): the two maxima of every saddle, see
+            saddle_table. Defaults to None.
     
     Description:
+        The saddle table is built in one pass by saddle_table and written to the
+        polydata column by column.
 
     Returns:
         vtk polydata: coords, index type, function at the saddle points, saddle index, max1, max2
+        np array: sorted ids of the maxima connected to the saddles
     """
-    cpList = []
-    for s in tqdm(surv_sads):
-        s, index = int(s), 2  # saddle index - 2
-        # maxList is the max critical points connected with s
-        co_ords, val, maxList = msc.cp_cellid(
-            s), msc.cp_func(s), msc.asc(s)[:, 0]
-        cpList.append((co_ords, index, val, s, maxList[0], maxList[1], 
-                       msc.cp_func(maxList[0]), msc.cp_func(maxList[1])))
-
-    # cpList = list(set(cpList))
+    table = saddle_table(msc, surv_sads, sad_maxima)
+    if table_file is not None:
+        np.savez(table_file, **table)
 
     # create the vtk objects
-    # (pa => coords(), ia => index, fa => val)
-    pa, ia = vtk.vtkPoints(), vtk.vtkIntArray()
-    fa, cp_ids = vtk.vtkFloatArray(), vtk.vtkIntArray()
-    max_1, max_2 = vtk.vtkIntArray(), vtk.vtkIntArray()
-    max_1_values, max_2_values = vtk.vtkFloatArray(), vtk.vtkFloatArray()
-    ia.SetName("Index")
-    fa.SetName("Val")
-    cp_ids.SetName("CP ID")
-    max_1.SetName("Max 1")
-    max_2.SetName("Max 2")
-    max_1_values.SetName("Max 1 Val")
-    max_2_values.SetName("Max 2 Val")
-    maxs = []
-
-    ca = vtk.vtkCellArray()
-    for i, (p, idx, val, cpidx, m1idx, m2idx, m1val, m2val) in tqdm(enumerate(cpList)):
-        pa.InsertNextPoint(np.array(p, np.float32)/2)
-        ia.InsertNextValue(idx)
-        fa.InsertNextValue(val)
-        max_1.InsertNextValue(m1idx)
-        max_2.InsertNextValue(m2idx)
-        max_1_values.InsertNextValue(m1val)
-        max_2_values.InsertNextValue(m2val)
-        cp_ids.InsertNextValue(cpidx)
-        ca.InsertNextCell(1)
-        ca.InsertCellPoint(i)
-        maxs.append(m1idx)
-        maxs.append(m2idx)
-
-    # Set the outputs
-    pd = vtk.vtkPolyData()
-    pd.SetPoints(pa)
-    pd.SetVerts(ca)
-    pd.GetPointData().AddArray(ia)
-    pd.GetPointData().AddArray(fa)
-    pd.GetPointData().AddArray(cp_ids)
-    pd.GetPointData().AddArray(max_1)
-    pd.GetPointData().AddArray(max_2)
-    pd.GetPointData().AddArray(max_1_values)
-    pd.GetPointData().AddArray(max_2_values)
+    num_sads = len(table["saddle"])
+    pd = build_polydata(table["position"], verts=vert_cells(num_sads), point_data=[
+        to_vtk_array(np.full(num_sads, 2), "Index", np.int32),  # saddle index - 2
+        to_vtk_array(table["value"], "Val", np.float32),
+        to_vtk_array(table["saddle"], "CP ID", np.int32),
+        to_vtk_array(table["max1"], "Max 1", np.int32),
+        to_vtk_array(table["max2"], "Max 2", np.int32),
+        to_vtk_array(table["max1_val"], "Max 1 Val", np.float32),
+        to_vtk_array(table["max2_val"], "Max 2 Val", np.float32)])
+    maxs = np.unique(np.concatenate((table["max1"], table["max2"])))
     return pd, maxs
 
 
-def get_segmentation_index_dual(msc, img, rtype="VTP"):
+def get_segmentation_index_dual(msc, img, rtype="VTP", msc_file=None,
+                                pers_thresh=None, export_dir=None, parallel=True):
     """Get the segmentation from morse smale complex
 
     Args:
         msc (msc object): Morse Complex object
         img (np array): Distance field
         rtype (str, optional): "VTP" or "NP". Defaults to "VTP".
+        msc_file (str, optional): file saved by initial_msc. Defaults to None.
+        pers_thresh (float, optional): threshold msc was simplified with. Defaults to None.
+        export_dir (str, optional): also write a vtp file per grain here ("VTP" only).
+            Defaults to None.
+        parallel (bool, optional): label the "NP" volume with a worker pool. Defaults to True.
     
     Description:
+        The descending manifolds of the maxima come from the geometry store (see
+        geom_store) saved next to msc_file, the workers memory-map it (or inherit an
+        in-memory store when forked without msc_file) instead of loading the complex.
+        "VTP": every worker packs the points of its grains into shared memory.
+        The parent copies them into one polydata, no per grain files are needed.
+        "NP": the workers label a shared uint32 volume and return the per grain
+        centers and volumes; the labels are identical to the serial loop.
 
     Raises:
         TypeError: "VTP" and "NP" are allowed as output
@@ -709,7 +938,6 @@ def get_segmentation_index_dual(msc, img, rtype="VTP"):
         np array: numpy array as segmentation or vtp as segmenation
     """
     # descending manifold of maxima
-    msc.collect_geom(dim=3, dir=0)
     # ''' critical points type
     # dim: Critical point type \n"\
     #     "   dim=-1      --> All (default)\n"\
@@ -719,98 +947,125 @@ def get_segmentation_index_dual(msc, img, rtype="VTP"):
     #     "   dir=1 --> Ascending \n"\
     #     "   dir=2 --> Both (default) \n"\
     # '''
+    store, prefix = geom_store(msc, 3, 0, "dual", msc_file, pers_thresh)
 
     # point coordinates
-    dp = msc.dual_points()
-    cps_max = msc.cps(3)
+    dp = store['points']
+    cps_max = np.asarray(msc.cps(3), dtype=np.int64)
+    # maxima in the background have no grain
+    fg = msc.cps_func()[cps_max] > 0
+    fg_max = cps_max[fg]
     if rtype == "VTP":
-        
-        ensem_dir = "../Outputs/grains/"
 
-        for dir in [ensem_dir]:
-            if not os.path.exists(dir):
-                os.mkdir(dir)
+        if export_dir is not None and not os.path.exists(export_dir):
+            os.makedirs(export_dir)
 
         start_time = time.time()
 
         num_proc = cpu_count()
         print("Number of processors: ", num_proc)
 
-        proc_works = [[] for i in range(num_proc)]
-        for i, m in enumerate(cps_max):
-            proc_works[i % num_proc].append(m)
-        
-        list_procs = []
-
-        for i in range(num_proc):
-            l_p = Process(target=multiproc.proc_work, args=(proc_works[i], msc, dp, img, ensem_dir))
-            list_procs.append(l_p)
-            l_p.start()
-            print("Started process ", i)
-        
-        for l_p in list_procs:
-            l_p.join()
-            print("Joined process ", l_p.pid)
-
-        poly_data = vtk.vtkPolyData()
-
-        pa, cp_ids = vtk.vtkPoints(), vtk.vtkIntArray()
-        ca, val = vtk.vtkCellArray(), vtk.vtkFloatArray()
-        cp_ids.SetName("CP ID")
-        val.SetName('Distance Val')
-        count = 0
-
-        print("Merging files from: ", ensem_dir)
+        # small contiguous chunks of maxima keep the workers balanced
+        # and the merged points in the order of cps_max
+        chunk_size = max(1, min(256, len(fg_max) // (4 * num_proc)))
+        proc_works = [fg_max[i:i + chunk_size]
+                      for i in range(0, len(fg_max), chunk_size)]
 
-        for grain_pd_file in tqdm(os.listdir(ensem_dir)):
-
-            # grain_cp_id.vtp
-
-            reader = vtk.vtkXMLPolyDataReader()
-            reader.SetFileName(ensem_dir + grain_pd_file)
-            # print("Reading file: ", ensem_dir + grain_pd_file)
-            reader.Update()
-            grain_pd = reader.GetOutput()
-
-            for i in range(grain_pd.GetNumberOfPoints()):
-                pa.InsertNextPoint(grain_pd.GetPoint(i))
-                cp_ids.InsertNextValue(grain_pd.GetPointData().GetArray("CP ID").GetValue(i))
-                val.InsertNextValue(grain_pd.GetPointData().GetArray("Distance Val").GetValue(i))
-                ca.InsertNextCell(1)
-                ca.InsertCellPoint(count)
-                count += 1
-            
-        poly_data.SetPoints(pa)
-        poly_data.SetVerts(ca)
-        poly_data.GetPointData().AddArray(cp_ids)
-        poly_data.GetPointData().AddArray(val)
+        img_shm, img_spec = multiproc.share_array(img)
+        # without a saved msc the forked workers inherit the store
+        initargs = (store if prefix is None else prefix, img_spec)
+        try:
+            with Pool(num_proc, initializer=multiproc.init_segmentation_worker,
+                      initargs=initargs) as pool:
+                results = pool.starmap(multiproc.segmentation_vtp_worker,
+                                       [(w, export_dir) for w in proc_works])
+        finally:
+            img_shm.close()
+            img_shm.unlink()
+
+        print("Merging grains of ", len(results), " tasks")
+
+        # copy the packed grains of every task into one set of arrays
+        num_pts = sum(n for n, _ in results)
+        pa = np.empty((num_pts, 3), np.float32)
+        cp_ids = np.empty(num_pts, np.int32)
+        val = np.empty(num_pts, np.float32)
+        start = 0
+        for n, spec in tqdm(results):
+            multiproc.unpack_shared(spec, [pa[start:start + n],
+                                           cp_ids[start:start + n],
+                                           val[start:start + n]])
+            start += n
+
+        poly_data = build_polydata(pa, verts=vert_cells(len(pa)), point_data=[
+            to_vtk_array(cp_ids, "CP ID", np.int32),
+            to_vtk_array(val, "Distance Val", np.float32)])
 
         print("Time taken for segmentation: ", time.time() - start_time, " seconds")
         return poly_data
 
 
+    elif rtype == "NP" and parallel:
+        num_proc = cpu_count()
+        print("Number of processors: ", num_proc)
+
+        # label volume holding the rank (position in cps_max + 1) of the
+        # maximum, one lock per block of voxels guards the updates
+        seg_shm = shared_memory.SharedMemory(
+            create=True, size=max(int(np.prod(img.shape)) * 4, 1))
+        seg_ranks = np.ndarray(img.shape, dtype=np.uint32, buffer=seg_shm.buf)
+        seg_ranks[...] = 0
+        locks = [Lock() for _ in range(min(64, img.shape[0]))]
+
+        chunk_size = max(1, min(256, len(fg_max) // (4 * num_proc)))
+        ranks = np.flatnonzero(fg) + 1
+        proc_works = [(ranks[i:i + chunk_size], fg_max[i:i + chunk_size])
+                      for i in range(0, len(fg_max), chunk_size)]
+
+        img_shm, img_spec = multiproc.share_array(img)
+        initargs = (store if prefix is None else prefix, img_spec,
+                    (seg_shm.name, img.shape, np.dtype(np.uint32).str), locks)
+        try:
+            with Pool(num_proc, initializer=multiproc.init_segmentation_worker,
+                      initargs=initargs) as pool:
+                results = pool.starmap(multiproc.segmentation_np_worker, proc_works)
+
+            # ranks to maxima ids
+            lut = np.zeros(len(cps_max) + 1, dtype=np.uint32)
+            lut[1:] = cps_max
+            seg_img = lut[seg_ranks]
+        finally:
+            del seg_ranks
+            for shm in (img_shm, seg_shm):
+                shm.close()
+                shm.unlink()
+
+        # grains in the order of cps_max
+        ranks = np.concatenate([np.empty(0, dtype=int)] + [r['ranks'] for r in results])
+        order = np.argsort(ranks)
+        # explicit shapes, no maxima may survive in the foreground
+        centers = np.array([v for r in results for v in r['centers']],
+                           dtype=float).reshape(len(ranks), 3)[order]
+        vols = np.array([v for r in results for v in r['vols']],
+                        dtype=np.int64).reshape(len(ranks))[order]
+        labs = cps_max[ranks[order] - 1]
+        maxima = msc.cps_cellid()[labs].astype(float).reshape(-1, 3)/2
+        print(f'Number of particles segmented: {len(labs)}')
+        return seg_img, centers, maxima, labs, vols
+
     elif rtype == "NP":
         count = 0
         seg_img = np.full(img.shape, 0, dtype=np.uint32, order='C')
         centers, maxima, labs, vols = [], [], [], []
-        for m in cps_max:
-            if (msc.cp_func(m) <= 0):
+        for m, row in zip(fg_max, cp_rows(store, fg_max)):
+            points_ind = multiproc.grain_voxels(cp_geom(store, row), dp, img)
+            if len(points_ind) == 0:
                 continue
-            des_geom = msc.des_geom(m)
-
-            # we loose information by converting to int <--- issure here
-            points = surv_voxs(dp[des_geom].astype(int), img)
-            if len(points) == 0:
-                pts = collect_neighbours(dp[des_geom])
-                points = surv_voxs(pts, img)
-                if len(points) == 0:
-                    continue
-            points_ind = np.ravel_multi_index(points.transpose(), img.shape)
             np.put(seg_img, points_ind, m)
-            centers.append(np.mean(points, axis=0))
-            maxima.append(np.array(msc.cp_cellid(m), dtype=np.float)/2)
+            centers.append(np.mean(np.unravel_index(points_ind, img.shape), axis=1))
+            maxima.append(np.array(msc.cp_cellid(m), dtype=float)/2)
             labs.append(m)
-            vols.append(points.shape[0])
+            vols.append(len(points_ind))
             count += 1
         print(f'Number of particles segmented: {count}')
         centers, maxima, labs, vols = np.array(centers), np.array(
@@ -821,6 +1076,42 @@ def get_segmentation_index_dual(msc, img, rtype="VTP"):
     return None
 
 
+def label_counts_centers(seg, slab_size=64):
+    """Voxel count and center of every label of a volume
+
+    Args:
+        seg (np array): label volume
+        slab_size (int, optional): number of x-slices counted at a time. Defaults to 64.
+
+    Description:
+        The labels are mapped to 0..n-1 with label_stats.compact_lut so the counts are
+        sized by the labels present, not by the largest label.
+
+    Returns:
+        np array: labels present in the volume, sorted
+        np array: lookup table from the labels to their index in the other arrays
+        np array: voxel count of every present label
+        np array: center of every present label (n, 3)
+    """
+    present, lut = compact_lut(seg)
+    num_labels = len(present)
+    counts = np.zeros(num_labels, dtype=np.int64)
+    sums = np.zeros((num_labels, 3))
+    _, ny, nz = seg.shape
+    y, z = np.meshgrid(np.arange(ny), np.arange(nz), indexing='ij')
+    for x0 in range(0, seg.shape[0], slab_size):
+        slab = seg[x0:x0 + slab_size]
+        flat, n = lut[slab.ravel()], slab.shape[0]
+        counts += np.bincount(flat, minlength=num_labels)
+        sums[:, 0] += np.bincount(flat, minlength=num_labels,
+                                  weights=np.repeat(np.arange(x0, x0 + n), ny * nz))
+        sums[:, 1] += np.bincount(flat, minlength=num_labels,
+                                  weights=np.tile(y.ravel(), n))
+        sums[:, 2] += np.bincount(flat, minlength=num_labels,
+                                  weights=np.tile(z.ravel(), n))
+    return present, lut, counts, sums / counts[:, np.newaxis]
+
+
 def read_input_file(filename, factor=1):
     """Read and downsample mat/raw file into numpy array
 
@@ -829,6 +1120,11 @@ def read_input_file(filename, factor=1):
         factor (int, optional): Downsampling factor. Defaults to 1.
     
     Description:
+        The volume is read slab by slab (see volume_reader.read_volume), mhd payloads
+        are memory-mapped and v7.3 mat files are read through h5py, so the full
+        resolution volume is never held in memory when downsampling. Edge blocks of
+        shapes that are not a multiple of the factor average over their valid
+        voxels instead of being zero padded.
 
     Raises:
         Exception: Not able to read mat file
@@ -839,33 +1135,9 @@ def read_input_file(filename, factor=1):
     file_ext = filename.split(".")[-1]
     if file_ext == "mat":
         print("reading mat file : " + filename)
-        try:
-            # if saved wih -v7.3 flag
-            f = h5py.File(f'{filename}', 'r')
-            sci = False
-        except OSError:
-            # else
-            f = io.loadmat(f'{filename}')
-            sci = True
-        except:
-            print("Something went wrong")
-            raise Exception('Not able to read the mat file.')
-
-        data = f.get('volm')
-        arr = np.array(data)
-        if sci:
-            arr = np.transpose(arr, axes=[2, 1, 0])
     elif file_ext == "mhd":
         print("reading raw file : " + filename)
-        file_reader = sitk.ImageFileReader()
-        file_reader.SetFileName(filename)
-        file_reader.SetImageIO('')
-        image = file_reader.Execute()
-        arr = sitk.GetArrayFromImage(image)
-    print("Original Shape : ", arr.shape)
-    if (factor > 1):
-        arr = block_reduce(arr, (factor, factor, factor),
-                           func=np.mean).astype(np.uint16)
+    arr = read_volume(filename, factor)
     print("New Shape : ", arr.shape)
     return arr
 
@@ -895,19 +1167,85 @@ def read_msc_to_img(msc, dim):
     return np_arr  # flatten order - F
 
 
-def surv_voxs(points, img):
-    """This function removes the voxels in background from the list of voxels.
+def saddle_table(msc, surv_sads, sad_maxima=None):
+    """Columnar table of the surviving saddles and the maxima they connect
 
     Args:
-        points (np array): array of voxel coordinates
-        img (np array): image
+        msc (msc object): Morse complex object
+        surv_sads (list): indices of saddle points that survived
+        sad_maxima (np array, optional): the two maxima of every saddle (n, 2) as
+            returned by compute_contact_regions. Defaults to None, they are then read
+            with msc.asc.
     
     Description:
+        Positions and function values are gathered from the bulk cps_cellid and
+        cps_func arrays, so the only per saddle call is msc.asc for the two maxima,
+        and none when sad_maxima is given.
 
     Returns:
-        np array: surviving voxel coordinates
+        dict: numpy arrays saddle, position, value, max1, max2, max1_val, max2_val
     """
-    points_ind = np.ravel_multi_index(points.transpose(), img.shape)
-    points_val = img.ravel()[points_ind]
-    points = points[points_val > 0, ...]
-    return points
\ No newline at end of file
+    sads = np.asarray(surv_sads, dtype=np.int64).ravel()
+    funcs = msc.cps_func()
+    # maxList is the max critical points connected with s
+    if sad_maxima is None:
+        sad_maxima = [msc.asc(s)[:2, 0] for s in sads]
+    maxList = np.asarray(sad_maxima, dtype=np.int64).reshape(-1, 2)
+    return dict(
+        saddle=sads,
+        position=msc.cps_cellid()[sads].astype(np.float32).reshape(-1, 3)/2,
+        value=funcs[sads],
+        max1=maxList[:, 0],
+        max2=maxList[:, 1],
+        max1_val=funcs[maxList[:, 0]],
+        max2_val=funcs[maxList[:, 1]],
+    )
+
+
+def threshold_slice(slice, filterName='InterMode', ace=False, win_size=0,
+                    ace_iter=200, ace_tol=0):
+    """Threshold a single slice of the image
+
+    Args:
+        slice (np array): two-dimensional attenuation density image
+        filterName (str, optional): filter of THRESHOLD_FILTERS. Defaults to 'InterMode'.
+        ace (bool, optional): active countour as boundary if true. Defaults to False.
+        win_size (int, optional): window side of the Adaptive filter. Defaults to 0.
+        ace_iter (int, optional): maximum iterations of the active contour. Defaults to 200.
+        ace_tol (float, optional): early stopping tolerance, see active_contour.
+            Defaults to 0.
+
+    Description:
+        Slicewise step of bd_extraction, used by the serial and the parallel mode.
+
+    Returns:
+        float: threshold of the slice
+        np array: binary slice (float32)
+        int: iterations of the active contour, 0 without it
+    """
+    filterType = THRESHOLD_FILTERS[filterName]
+
+    # thresholding
+    if filterName == 'Min':
+        # minimum filter
+        filter = filterType.New(itk.GetImageFromArray(slice))
+        filter.SetInput(itk.GetImageFromArray(slice))
+        filter.UseInterModeOff()
+        filter.Update()
+        thresh = filter.GetThreshold()
+
+    elif filterName == 'Adaptive':
+        # adaptive thresholding
+        slice = filterType(slice, T=0.10, win_size=win_size)
+        thresh = 100
+
+    else:
+        # sitk filter
+        filter = filterType()
+        filter.Execute(sitk.GetImageFromArray(slice))
+        thresh = filter.GetThreshold()
+
+    # active contour
+    if ace:
+        return (thresh,) + active_contour(slice, thresh, ace_iter, ace_tol)
+    return thresh, (slice > thresh).astype(np.float32), 0
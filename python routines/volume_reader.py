@@ -0,0 +1,166 @@
+# import modules
+import h5py
+import numpy as np
+import os
+from scipy import io
+import SimpleITK as sitk
+from downsample import downsample
+
+# Read input volumes without holding more than one slab of the full resolution
+# data in memory: MetaImage payloads are memory-mapped, MAT v7.3 files are read
+# slab by slab through h5py and the downsampling is done per slab.
+
+# numpy types of the MetaImage element types
+MET_TYPES = dict(
+    MET_CHAR=np.int8,
+    MET_UCHAR=np.uint8,
+    MET_SHORT=np.int16,
+    MET_USHORT=np.uint16,
+    MET_INT=np.int32,
+    MET_UINT=np.uint32,
+    MET_LONG_LONG=np.int64,
+    MET_ULONG_LONG=np.uint64,
+    MET_FLOAT=np.float32,
+    MET_DOUBLE=np.float64,
+)
+
+
+def read_mhd_header(filename):
+    """Read the fields of a MetaImage header.
+
+    Args:
+        filename (str): mhd file
+
+    Returns:
+        dict: value of every field as a string
+    """
+    header = {}
+    with open(filename, mode='r', errors='replace') as f:
+        for line in f:
+            key, sep, value = line.partition('=')
+            if sep:
+                header[key.strip()] = value.strip()
+            # the data of a LOCAL file follows this field
+            if key.strip() == 'ElementDataFile':
+                break
+    return header
+
+
+def map_mhd(filename):
+    """Memory-map the payload of a MetaImage file.
+
+    Args:
+        filename (str): mhd file
+
+    Description:
+        The map is copy-on-write: the array can be changed in memory, the file is
+        never written. Compressed, multi-channel, multi-file and LOCAL payloads
+        cannot be mapped.
+
+    Returns:
+        numpy memmap: volume (z, y, x) as sitk.GetArrayFromImage returns it, None if
+            the payload cannot be mapped
+    """
+    header = read_mhd_header(filename)
+    data_file = header.get('ElementDataFile', 'LOCAL')
+    if (header.get('CompressedData', 'False').lower() == 'true'
+            or int(header.get('ElementNumberOfChannels', 1)) != 1
+            or header.get('ElementType') not in MET_TYPES
+            or data_file == 'LOCAL' or data_file.startswith('LIST')
+            or '%' in data_file):
+        return None
+
+    shape = tuple(int(d) for d in header['DimSize'].split())[::-1]
+    msb = (header.get('BinaryDataByteOrderMSB', header.get('ElementByteOrderMSB', 'False'))
+           .lower() == 'true')
+    dtype = np.dtype(MET_TYPES[header['ElementType']]).newbyteorder('>' if msb else '<')
+    data_file = os.path.join(os.path.dirname(filename), data_file)
+
+    # a header size of -1 places the data at the end of the file
+    offset = int(header.get('HeaderSize', 0))
+    if offset == -1:
+        offset = os.path.getsize(data_file) - int(np.prod(shape)) * dtype.itemsize
+    return np.memmap(data_file, dtype=dtype, mode='c', offset=offset, shape=shape)
+
+
+def open_volume(filename):
+    """Open the volume of a mhd or mat file without reading it.
+
+    Args:
+        filename (str): mhd file, or mat file with the volm array
+
+    Raises:
+        Exception: Not able to read mat file
+
+    Returns:
+        array like: memory map, h5py dataset or numpy array; slicing the first
+            axis reads the slices. The file of a h5py dataset (dataset.file) is
+            left open for the caller to close.
+    """
+    file_ext = filename.split(".")[-1]
+    if file_ext == "mat":
+        try:
+            # if saved wih -v7.3 flag, the dataset is read slab by slab
+            return h5py.File(f'{filename}', 'r')['volm']
+        except OSError:
+            # else
+            pass
+        try:
+            return np.transpose(io.loadmat(f'{filename}')['volm'], axes=[2, 1, 0])
+        except Exception:
+            raise Exception('Not able to read the mat file.')
+
+    arr = map_mhd(filename)
+    if arr is None:
+        file_reader = sitk.ImageFileReader()
+        file_reader.SetFileName(filename)
+        file_reader.SetImageIO('')
+        arr = sitk.GetArrayFromImage(file_reader.Execute())
+    return arr
+
+
+def read_volume(filename, factor=1, slab_size=64):
+    """Read and downsample a mhd or mat volume slab by slab.
+
+    Args:
+        filename (str): mhd file, or mat file with the volm array
+        factor (int, optional): Downsampling factor. Defaults to 1.
+        slab_size (int, optional): slices read at a time, rounded down to a multiple
+            of factor. Defaults to 64.
+
+    Description:
+        Every slab is reduced with a block mean into the preallocated output (see
+        downsample.downsample), the result is the same as downsampling the whole
+        volume at once. For every input type, blocks at the end of an axis that is
+        not a multiple of the factor take the mean over their valid voxels; the
+        former block_reduce of read_input_file padded them with zeros, which
+        darkened the last plane of such volumes. Without downsampling a mapped
+        MetaImage is returned as a copy-on-write map. The file of a v7.3 mat volume
+        is closed once the volume is read.
+
+    Returns:
+        numpy array: downsampled volume
+    """
+    src = open_volume(filename)
+    print("Original Shape : ", src.shape)
+
+    if isinstance(src, h5py.Dataset):
+        with src.file:
+            return _read_slabs(src, factor, slab_size)
+    return _read_slabs(src, factor, slab_size)
+
+
+def _read_slabs(src, factor, slab_size):
+    """Read and downsample an opened volume slab by slab, see read_volume."""
+    if factor <= 1:
+        if isinstance(src, h5py.Dataset):
+            return src[()]
+        if not src.dtype.isnative:
+            return src.astype(src.dtype.newbyteorder('='))
+        return src
+
+    out = np.empty(tuple(-(-n // factor) for n in src.shape), dtype=np.uint16)
+    step = factor * max(1, slab_size // factor)
+    for i in range(0, src.shape[0], step):
+        downsample(src[i:i + step], factor, out=out[i // factor:(i + step) // factor])
+    return out